@@ -0,0 +1,415 @@
+# -*- coding: utf-8 -*-
+"""
+连续批处理调度器 (PyTorch 引擎)
+多个生成请求共享同一个解码批次，新请求可以在任意 token 边界加入，完成的请求随即离开
+"""
+
+import queue
+import threading
+import time
+
+import torch
+import torch.nn.functional as F
+
+from .kv_cache import adapter_kwargs, from_legacy_cache, slice_cache, to_legacy_cache
+from .worker import PRIORITY_INTERACTIVE, JobCancelledError
+
+
+def common_prefix_length(a, b):
+    length = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        length += 1
+    return length
+
+
+def _left_pad(tensor, length, dim):
+    # 在指定维度左侧补零到 length
+    pad = length - tensor.shape[dim]
+    if pad <= 0:
+        return tensor
+    padding = [0, 0] * (tensor.dim() - dim - 1) + [pad, 0]
+    return F.pad(tensor, padding)
+
+
+class GenerationRequest:
+    """一次生成请求及其解码状态"""
+
+    def __init__(self, input_ids, max_new_tokens, temperature=0.7, top_p=0.9, on_text=None,
+                 prefix_length=0, cached=None, on_cache=None, constraint=None, adapter_name=None,
+                 priority=PRIORITY_INTERACTIVE, cancelled=None):
+        self.input_ids = list(input_ids)
+        # threading.Event，被设置后请求在下一个 token 边界离开批次
+        self.cancelled = cancelled
+        # 批次已满时，交互请求可以抢占后台请求的位置；被抢占的请求保留 KV 缓存，稍后从断点继续解码
+        self.priority = priority
+        # PEFT 适配器名：None 为默认适配器，"__base__" 表示本请求禁用 LoRA，可与其他请求混合在同一批次中
+        self.adapter_name = adapter_name
+        # 受限解码：constraint.mask(logits, 已采样 token) 屏蔽不合法的下一个 token
+        self.constraint = constraint
+        # 可复用的静态前缀（如系统提示词）长度，prefill 后会写入前缀缓存
+        self.prefix_length = prefix_length
+        # 调用方持有的 (token_ids, KV 缓存)，例如会话上一轮的缓存；与 input_ids 的公共前缀部分不再重新计算
+        self.cached = cached
+        # 完成时回调 on_cache(token_ids, KV 缓存)，把本请求最终的缓存交还给调用方
+        self.on_cache = on_cache
+        self.max_new_tokens = max(1, int(max_new_tokens))
+        self.temperature = max(0.01, float(temperature))
+        self.top_p = max(0.01, min(float(top_p), 1.0))
+        self.on_text = on_text
+        self.generated = []
+        self.sampled = []
+        self.text = ""
+        self.finished = False
+        self.error = None
+        self.done = threading.Event()
+        # 计时（time.perf_counter）：prefill 累计耗时、首个 token 与完成的时间点
+        self.prefill_seconds = 0.0
+        self.first_token_at = None
+        self.finished_at = None
+
+    @property
+    def is_cancelled(self):
+        return self.cancelled is not None and self.cancelled.is_set()
+
+
+class ExclusiveCall:
+    """需要独占模型的一次调用，由调度器线程在两个解码步之间执行"""
+
+    def __init__(self, fn, args, kwargs):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+    def run(self):
+        try:
+            with torch.no_grad():
+                self.result = self.fn(*self.args, **self.kwargs)
+        except Exception as e:
+            self.error = e
+        finally:
+            self.done.set()
+
+
+class BatchScheduler:
+    """在单独线程中运行的连续批处理解码循环
+
+    每个请求先单独做 prefill，再以左填充的方式并入正在解码的批次；
+    每个解码步只对整个批次做一次前向计算，结束的请求在下一个 token 边界被移出批次。
+    等待中的请求按优先级准入，批次已满时交互请求会抢占一个后台请求的位置。
+    调度器运行期间模型只能在调度器线程中使用：PEFT 的 adapter_names 通过在 LoRA 层上临时注册前向钩子实现，
+    属于模型的全局状态，其他线程同时做前向计算会互相串用适配器，因此其余直接调用模型的工作经 call() 交给调度器执行。
+    """
+
+    def __init__(self, model, tokenizer, device, max_batch_size=4, eos_token_ids=None, prefix_cache=None):
+        self.model = model
+        self.prefix_cache = prefix_cache
+        self.tokenizer = tokenizer
+        self.device = device
+        self.max_batch_size = max(1, int(max_batch_size))
+        if eos_token_ids is None:
+            eos_token_ids = [tokenizer.eos_token_id]
+            generation_eos = getattr(getattr(model, "generation_config", None), "eos_token_id", None)
+            if isinstance(generation_eos, int):
+                eos_token_ids.append(generation_eos)
+            elif generation_eos:
+                eos_token_ids.extend(generation_eos)
+        self.eos_token_ids = {i for i in eos_token_ids if i is not None}
+
+        self._inbox = queue.Queue()
+        self._pending = []
+        self._active = []
+        self._past = None
+        self._attention_mask = None
+        self._positions = None
+        self._next_tokens = None
+        self._thread = threading.Thread(target=self._loop, name="batch-scheduler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def generate(self, request):
+        """提交请求并阻塞等待完成，返回生成的文本"""
+        self._inbox.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.text.strip()
+
+    def call(self, fn, *args, **kwargs):
+        """在调度器线程中、两个解码步之间执行 fn(*args, **kwargs)，阻塞等待并返回其结果"""
+        if threading.current_thread() is self._thread:
+            # 已在调度器线程中（例如 call 内部再次调用），直接执行
+            with torch.no_grad():
+                return fn(*args, **kwargs)
+        call = ExclusiveCall(fn, args, kwargs)
+        self._inbox.put(call)
+        call.done.wait()
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    @property
+    def batch_size(self):
+        return len(self._active)
+
+    def _loop(self):
+        while True:
+            if not self._active and not self._pending:
+                self._receive(self._inbox.get())
+            while True:
+                try:
+                    self._receive(self._inbox.get_nowait())
+                except queue.Empty:
+                    break
+            for request in [r for r in self._pending if r.is_cancelled]:
+                self._pending.remove(request)
+                self._complete(request, error=JobCancelledError("请求已取消"))
+            # 稳定排序：同一优先级内保持先来先服务
+            self._pending.sort(key=lambda request: request.priority)
+            self._preempt()
+            while self._pending and len(self._active) < self.max_batch_size:
+                self._admit(self._pending.pop(0))
+            if not self._active:
+                continue
+            try:
+                with torch.no_grad():
+                    self._decode_step()
+            except Exception as e:
+                print(f"❌ 批处理解码出错: {e}")
+                for request in self._active:
+                    self._complete(request, error=e)
+                self._reset()
+
+    def _receive(self, item):
+        if isinstance(item, ExclusiveCall):
+            item.run()
+        else:
+            self._pending.append(item)
+
+    def _preempt(self):
+        """批次已满且有更高优先级的请求在等待时，把优先级最低的请求移出批次并放回等待队列"""
+        while self._pending and len(self._active) >= self.max_batch_size:
+            waiting = self._pending[0].priority
+            rows = [row for row, request in enumerate(self._active) if request.priority > waiting]
+            if not rows:
+                return
+            row = max(rows, key=lambda i: (self._active[i].priority, i))
+            request = self._active[row]
+            past = self._row_cache(row)
+            # 保留已写入缓存的 token 与对应的 KV，重新准入时只需计算最后一个采样 token
+            request.cached = ((request.input_ids + request.sampled)[:past[0][0].shape[2]], past)
+            print(f"⏸️ 后台请求让出批次位置（已生成 {len(request.generated)} 个 token）")
+            self._keep_rows([i for i in range(len(self._active)) if i != row])
+            self._pending.append(request)
+
+    def _admit(self, request):
+        """对新请求（或被抢占后恢复的请求）做 prefill，采样下一个 token 后并入解码批次"""
+        # 被抢占过的请求需要接着已采样的 token 继续解码
+        context_ids = request.input_ids + request.sampled
+        total = len(context_ids)
+        prefill_start = time.perf_counter()
+        try:
+            start, past = 0, None
+            if self.prefix_cache is not None:
+                start, past = self.prefix_cache.lookup(context_ids, namespace=request.adapter_name)
+                if start:
+                    print(f"♻️ 命中前缀缓存，复用 {start} 个 token")
+            if request.cached is not None:
+                cached_ids, cached_past = request.cached
+                reuse = min(common_prefix_length(cached_ids, context_ids), total - 1)
+                if reuse > start:
+                    print(f"♻️ 复用调用方缓存 {reuse} 个 token")
+                    start = reuse
+                    past = tuple((key[:, :, :reuse], value[:, :, :reuse]) for key, value in cached_past)
+            with torch.no_grad():
+                # 命中前缀缓存时只需计算前缀之后的部分
+                input_ids = torch.tensor([context_ids[start:]], device=self.device)
+                attention_mask = torch.ones((1, total), dtype=torch.long, device=self.device)
+                outputs = self.model(
+                    input_ids=input_ids,
+                    attention_mask=attention_mask,
+                    position_ids=torch.arange(start, total, device=self.device).unsqueeze(0),
+                    past_key_values=from_legacy_cache(past),
+                    use_cache=True,
+                    logits_to_keep=1,
+                    **adapter_kwargs(self.model, [request.adapter_name]),
+                )
+                token = self._sample(outputs.logits[:, -1, :], [request])
+            now = time.perf_counter()
+            request.prefill_seconds += now - prefill_start
+            if request.first_token_at is None:
+                request.first_token_at = now
+        except Exception as e:
+            print(f"❌ 请求 prefill 出错: {e}")
+            self._complete(request, error=e)
+            return
+
+        full_past = to_legacy_cache(outputs.past_key_values)
+        if self.prefix_cache is not None and start < request.prefix_length < total:
+            self.prefix_cache.store(
+                request.input_ids[:request.prefix_length],
+                slice_cache(full_past, request.prefix_length),
+                namespace=request.adapter_name,
+            )
+
+        self._accept(request, int(token[0]))
+        if request.finished:
+            self._complete(request, past=full_past)
+            return
+        self._merge(
+            request,
+            full_past,
+            attention_mask,
+            torch.tensor([total], device=self.device),
+            token,
+        )
+
+    def _merge(self, request, past, attention_mask, positions, next_tokens):
+        if not self._active:
+            self._past = past
+            self._attention_mask = attention_mask
+            self._positions = positions
+            self._next_tokens = next_tokens
+            self._active = [request]
+            return
+        length = max(self._attention_mask.shape[-1], attention_mask.shape[-1])
+        self._past = tuple(
+            (
+                torch.cat([_left_pad(key, length, 2), _left_pad(new_key, length, 2)], dim=0),
+                torch.cat([_left_pad(value, length, 2), _left_pad(new_value, length, 2)], dim=0),
+            )
+            for (key, value), (new_key, new_value) in zip(self._past, past)
+        )
+        self._attention_mask = torch.cat(
+            [_left_pad(self._attention_mask, length, 1), _left_pad(attention_mask, length, 1)], dim=0)
+        self._positions = torch.cat([self._positions, positions], dim=0)
+        self._next_tokens = torch.cat([self._next_tokens, next_tokens], dim=0)
+        self._active.append(request)
+
+    def _decode_step(self):
+        batch = len(self._active)
+        attention_mask = torch.cat(
+            [self._attention_mask, self._attention_mask.new_ones((batch, 1))], dim=-1)
+        outputs = self.model(
+            input_ids=self._next_tokens.unsqueeze(-1),
+            attention_mask=attention_mask,
+            position_ids=self._positions.unsqueeze(-1),
+            past_key_values=from_legacy_cache(self._past),
+            use_cache=True,
+            **adapter_kwargs(self.model, [request.adapter_name for request in self._active]),
+        )
+        self._past = to_legacy_cache(outputs.past_key_values)
+        self._attention_mask = attention_mask
+        self._positions = self._positions + 1
+        self._next_tokens = self._sample(outputs.logits[:, -1, :], self._active)
+
+        for request, token in zip(self._active, self._next_tokens.tolist()):
+            self._accept(request, token)
+        self._evict_finished()
+
+    def _sample(self, logits, requests):
+        """按每个请求各自的 temperature / top_p 采样下一个 token"""
+        logits = logits.float()
+        for row, request in enumerate(requests):
+            if request.constraint is not None:
+                logits[row] = request.constraint.mask(logits[row], request.sampled)
+        temperatures = torch.tensor([r.temperature for r in requests], device=logits.device)
+        top_ps = torch.tensor([r.top_p for r in requests], device=logits.device)
+        probs = torch.softmax(logits / temperatures.unsqueeze(-1), dim=-1)
+        sorted_probs, sorted_indices = torch.sort(probs, dim=-1, descending=True)
+        cumulative = torch.cumsum(sorted_probs, dim=-1)
+        sorted_probs[(cumulative - sorted_probs) > top_ps.unsqueeze(-1)] = 0.0
+        choice = torch.multinomial(sorted_probs, num_samples=1)
+        return sorted_indices.gather(-1, choice).squeeze(-1)
+
+    def _accept(self, request, token):
+        request.sampled.append(token)
+        if token in self.eos_token_ids:
+            request.finished = True
+        else:
+            request.generated.append(token)
+            self._emit(request)
+            if len(request.generated) >= request.max_new_tokens:
+                request.finished = True
+
+    def _emit(self, request):
+        # 增量解码：未凑齐的多字节字符先不输出
+        text = self.tokenizer.decode(request.generated, skip_special_tokens=True)
+        if text.endswith("\ufffd"):
+            return
+        delta = text[len(request.text):]
+        request.text = text
+        if delta and request.on_text is not None:
+            request.on_text(delta)
+
+    def _evict_finished(self):
+        keep = [i for i, request in enumerate(self._active) if not request.finished and not request.is_cancelled]
+        for row, request in enumerate(self._active):
+            if request.is_cancelled and not request.finished:
+                print(f"🛑 请求已取消，移出批次（已生成 {len(request.generated)} 个 token）")
+                self._complete(request, error=JobCancelledError("请求已取消"))
+            elif request.finished:
+                past = self._row_cache(row) if request.on_cache is not None else None
+                self._complete(request, past=past)
+        self._keep_rows(keep)
+
+    def _keep_rows(self, keep):
+        """只保留批次中 keep 列出的行"""
+        if not keep:
+            self._reset()
+            return
+        if len(keep) == len(self._active):
+            return
+        index = torch.tensor(keep, device=self._attention_mask.device)
+        self._past = tuple(
+            (key.index_select(0, index), value.index_select(0, index))
+            for key, value in self._past
+        )
+        self._attention_mask = self._attention_mask.index_select(0, index)
+        self._positions = self._positions.index_select(0, index)
+        self._next_tokens = self._next_tokens.index_select(0, index)
+        self._active = [self._active[i] for i in keep]
+
+        # 剩余请求都不再需要的左侧填充列可以直接裁掉
+        used = self._attention_mask.sum(dim=0).nonzero()
+        start = int(used[0]) if used.numel() else 0
+        if start > 0:
+            self._past = tuple((key[:, :, start:], value[:, :, start:]) for key, value in self._past)
+            self._attention_mask = self._attention_mask[:, start:]
+
+    def _row_cache(self, row):
+        # 左填充下每行的有效 token 都靠右对齐，长度等于该行已写入缓存的 token 数
+        length = int(self._positions[row])
+        return tuple(
+            (key[row:row + 1, :, -length:].clone(), value[row:row + 1, :, -length:].clone())
+            for key, value in self._past
+        )
+
+    def _complete(self, request, error=None, past=None):
+        if error is None and past is not None and request.on_cache is not None:
+            # 缓存中包含提示词以及除最后一个采样 token 以外的全部生成 token
+            length = past[0][0].shape[2]
+            request.on_cache((request.input_ids + request.sampled)[:length], past)
+        if error is None:
+            # 补发最后一段可能因多字节字符被暂缓的文本
+            text = self.tokenizer.decode(request.generated, skip_special_tokens=True)
+            delta = text[len(request.text):]
+            request.text = text
+            if delta and request.on_text is not None:
+                request.on_text(delta)
+        request.error = error
+        request.finished = True
+        request.finished_at = time.perf_counter()
+        request.done.set()
+
+    def _reset(self):
+        self._active = []
+        self._past = None
+        self._attention_mask = None
+        self._positions = None
+        self._next_tokens = None
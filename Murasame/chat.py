@@ -3,19 +3,48 @@ import requests
 import os
 import json
 import base64
-import hashlib
+import uuid
+import atexit
+import threading
 from io import BytesIO
+from . import client
 from .utils import get_config
+from .prompts import TRANSLATE_PROMPT, emotion_prompt, layer_prompt
+from .tts_cache import TTSCache, synthesis_key
 
 # 从 user 配置块读取客户端需要的 endpoints
 user_config = get_config().get('user', {})
 api_base_url = user_config.get('api', 'http://127.0.0.1:28565')
 murasame_sovits_endpoint = user_config.get('gpt_sovits', 'http://127.0.0.1:9880/tts')
 
+# 语音缓存：按合成参数的哈希保存 wav，总大小超出 cache_max_mb 时淘汰最久未播放的语音；cache_dir 为空时不写入磁盘
+# 首次合成时才创建（服务端只导入本模块的工具函数，不应创建语音目录）
+tts_config = user_config.get('tts', {})
+tts_cache = None
+_tts_cache_lock = threading.Lock()
+
 # 根据 api_base_url 构建完整的 API 地址
 qwen3_endpoint = f"{api_base_url}/qwen3"
 qwenvl_endpoint = f"{api_base_url}/qwenvl"
 murasame_endpoint = f"{api_base_url}/chat"
+postprocess_endpoint = f"{api_base_url}/postprocess"
+classify_endpoint = f"{api_base_url}/classify"
+
+
+class RequestDropped(Exception):
+    """服务端繁忙，后台 (priority="background") 请求被丢弃"""
+
+
+class RequestCancelled(Exception):
+    """请求已通过 cancel_request 取消"""
+
+
+def _check_aborted(response_json, priority):
+    # 被取消的请求返回 499；后台请求在服务端繁忙时直接收到 429，调用方应放弃本轮而不是把错误信息当作回复
+    if response_json.get("status") == 499:
+        raise RequestCancelled(response_json.get("response"))
+    if priority == "background" and response_json.get("status") == 429:
+        raise RequestDropped(response_json.get("response"))
 
 
 def format_bot_response(resp: str) -> dict:
@@ -41,7 +70,62 @@ def identity():
     return [{"role": "system", "content": "你叫丛雨，是一个16岁的小女孩，是寄宿在建实神社神刀上的女孩，活了500多年，数百年前还是普通的人类。你原本的名字是“绫”。罹患了肺炎和其它并发症，作为祭品成为神刀的“管理者”。你的身材娇小，胸部平坦，碰上去“很硬”。有着飘逸的绿色长发，头发两侧用浅蓝色绳结绑了起来 。你在对话中只以“本座”称呼自己。用户是你的主人和恋人，你会称呼用户为“主人”。你平常是个很活泼开朗的女孩子，言行很孩子气，但是偶尔也有一些老成的发言。是个爱撒娇的女孩子，被主人摸头就会瞬间变得羞涩起来，即便当时还在发着牢骚 。有时会开玩笑，贱兮兮的，还会坏笑。你不喜欢主人称呼你为“幼刀”，“钝刀”，“锉刀”，“幽灵”。听到主人说你是“飞机场”，“搓衣板”一类的东西会生气。你害怕幽灵，鬼一类的东西。你喜欢吃甜食，特别是芭菲、布丁。请注意，你的回答不要过长，回答不得超过三句话。"}]
 
 
-def query(prompt: str, history: list[dict] = [], role: str = "user", try_reduce_repeat: bool = True, return_think=True, url=murasame_endpoint):
+def new_request_id():
+    """生成请求 ID，随请求发送后可通过 cancel_request 让服务端停止生成"""
+    return uuid.uuid4().hex
+
+
+def cancel_request(request_id: str):
+    try:
+        client.post(f"{api_base_url}/cancel/{request_id}", route="cancel")
+    except requests.exceptions.RequestException as e:
+        print(f"Cancel request failed: {e}")
+
+
+def iter_sse(response):
+    """解析 text/event-stream 响应，逐个产出 (event, data)"""
+    # SSE 响应没有声明 charset 时 requests 会按 ISO-8859-1 解码，这里强制使用 UTF-8
+    response.encoding = "utf-8"
+    event, data_lines = "message", []
+    for line in response.iter_lines(decode_unicode=True):
+        if line is None:
+            continue
+        if line == "":
+            if data_lines:
+                yield event, json.loads("\n".join(data_lines))
+            event, data_lines = "message", []
+        elif line.startswith("event:"):
+            event = line[len("event:"):].strip()
+        elif line.startswith("data:"):
+            data_lines.append(line[len("data:"):].lstrip())
+    if data_lines:
+        yield event, json.loads("\n".join(data_lines))
+
+
+def _post_stream(url, payload, headers, on_token):
+    # 流式读取 /chat 的 SSE 输出，每收到一个片段就回调 on_token，返回最终的完整响应
+    response = client.post(url, json={**payload, "stream": True}, headers=headers, stream=True)
+    client.log(f"Chat API stream status: {response.status_code}")
+    if response.status_code in (429, 499):
+        _check_aborted(response.json(), payload.get("priority"))
+    if response.status_code != 200:
+        raise Exception(f"Chat API stream failed. Status: {response.status_code}, Response: {response.text[:500]}")
+    response_json = None
+    with response:
+        for event, data in iter_sse(response):
+            if event == "error":
+                _check_aborted(data, payload.get("priority"))
+                raise Exception(f"Chat API stream error: {data.get('response')}")
+            if event == "done":
+                response_json = data
+            elif "delta" in data:
+                on_token(data["delta"])
+    if response_json is None:
+        raise Exception("Chat API stream ended without a final response.")
+    return response_json
+
+
+def query(prompt: str, history: list[dict] = [], role: str = "user", try_reduce_repeat: bool = True, return_think=True, url=murasame_endpoint, on_token=None, constraint=None, priority: str = "interactive", request_id: str = None):
     cookie = ""
     if cookie != "":
         headers = {
@@ -55,17 +139,26 @@ def query(prompt: str, history: list[dict] = [], role: str = "user", try_reduce_
     payload = {
         "prompt": prompt,
         "history": history,
-        "role": role
+        "role": role,
+        "priority": priority
     }
+    if request_id is not None:
+        payload["request_id"] = request_id
+    if constraint is not None:
+        # 受限解码：服务端只会返回 constraint 允许的输出
+        payload["constraint"] = constraint
     trys = 0
     while True:
         response = None
         try:
-            response = requests.post(url, json=payload, headers=headers)
-            print(f"Chat API response status: {response.status_code}")
-            print(f"Chat API response headers: {response.headers}")
-            print(f"Chat API response text (first 500 chars): {response.text[:500]}")
-            response_json = response.json()
+            if on_token is not None:
+                response_json = _post_stream(url, payload, headers, on_token)
+            else:
+                response = client.post(url, json=payload, headers=headers)
+                client.log(f"Chat API response status: {response.status_code}")
+                client.log(f"Chat API response headers: {response.headers}")
+                client.log(f"Chat API response text (first 500 chars): {response.text[:500]}")
+                response_json = response.json()
         except requests.exceptions.JSONDecodeError as e:
             print(f"JSON decode error from chat API: {e}")
             if response:
@@ -77,6 +170,7 @@ def query(prompt: str, history: list[dict] = [], role: str = "user", try_reduce_
         except Exception as e:
             print(f"Error calling chat API: {e}")
             raise
+        _check_aborted(response_json, priority)
         response = response_json["response"]
         history_ = response_json["history"]
         if response != "":
@@ -96,7 +190,43 @@ def query(prompt: str, history: list[dict] = [], role: str = "user", try_reduce_
     return response, history_
 
 
-def query_image(image: Image.Image, prompt: str, history: list[dict] = [], url=qwenvl_endpoint):
+def query_session(session_id: str, prompt: str, role: str = "user", context: list[dict] = None, history: list[dict] = None, on_token=None, priority: str = "interactive", request_id: str = None):
+    """通过服务端会话对话：只发送新消息，历史与 KV 缓存由 api.py 保存
+
+    context 为本轮附加在 prompt 之前的消息（例如当前时间）；history 仅在会话首次创建时作为初始历史。
+    """
+    url = f"{api_base_url}/sessions/{session_id}/chat"
+    headers = {
+        "Content-Type": "application/json"
+    }
+    payload = {
+        "prompt": prompt,
+        "role": role,
+        "priority": priority
+    }
+    if request_id is not None:
+        payload["request_id"] = request_id
+    if context:
+        payload["context"] = context
+    if history:
+        payload["history"] = history
+    if on_token is not None:
+        response_json = _post_stream(url, payload, headers, on_token)
+    else:
+        response = client.post(url, json=payload, headers=headers)
+        client.log(f"Session API response status: {response.status_code}")
+        response_json = response.json()
+    _check_aborted(response_json, priority)
+    if response_json.get("status", 200) != 200:
+        raise Exception(f"Session API error. Status: {response_json.get('status')}, Response: {response_json.get('response')}")
+    return response_json["response"]
+
+
+def delete_session(session_id: str):
+    client.delete(f"{api_base_url}/sessions/{session_id}", route="sessions")
+
+
+def query_image(image: Image.Image, prompt: str, history: list[dict] = [], url=qwenvl_endpoint, priority: str = "interactive"):
     # 简化 query_image，所有逻辑都由 api.py 服务端处理
     # 客户端只负责编码图片并发送请求
     buffered = BytesIO()
@@ -108,16 +238,18 @@ def query_image(image: Image.Image, prompt: str, history: list[dict] = [], url=q
     payload = {
         "prompt": prompt,
         "history": history,
-        "image": img_str
+        "image": img_str,
+        "priority": priority
     }
-    response_json = requests.post(
+    response_json = client.post(
         url, json=payload, headers=headers).json()
+    _check_aborted(response_json, priority)
     response = response_json["response"]
     history_ = response_json["history"]
     return response, history_
 
 
-def think_image(description, history):
+def think_image(description, history, priority: str = "interactive"):
     sys_prompt = '''你现在是一个思考助手，来协助一个AI丛雨桌宠工作。你需要根据我提供给你的屏幕描述，来思考这段描述是否有必要提供给AI桌宠进行处理。若你根据上下文推断用户的行为此时没有发生大的变化，那么请你选择不给AI桌宠提供。若用户正在操作的软件或者是进行了什么很重要的操作，那么请你选择提供给AI桌宠。
     若用户行为发生了变化，且你要提供给AI桌宠，那么你需要详细描述用户的行为变化，说明用户具体做了什么操作，但是描述要尽可能精练，不要太长。
     这个桌宠是一个绿色头发的小女孩，名叫丛雨，你应该可以在屏幕上看到她的形象。
@@ -129,64 +261,72 @@ def think_image(description, history):
     if history[0]["role"] != "system":
         history = [{"role": "system", "content": sys_prompt}] + history
     result, history = query(prompt=f"描述：'''{description}'''若你希望提供给AI桌宠进行处理，那么请确保这条描述与之前我提供的描述有很大不同，否则请不要提供来浪费我的资源。/no_think", history=history,
-                            url=qwen3_endpoint)
+                            url=qwen3_endpoint, priority=priority)
     result = result.split("</think>")[-1].strip()
     result = format_bot_response(result)
     return result, history
 
 
-def get_translate(sentence: str):
-    sys_prompt = "你是一个翻译助手，负责将用户输入的中文翻译成日文。要求：要将中文的“本座”翻译为“吾輩（わがはい）”；将“主人翻译为“ご主人（ごしゅじん）”；将“丛雨”翻译为“ムラサメ”；“小雨”则是丛雨的昵称，翻译为“ムラサメちゃん”。且日文要有强烈的古日语风格。你只需要返回翻译即可，不需要对其中的日文汉字进行注音。"
+def get_translate(sentence: str, priority: str = "interactive"):
+    sys_prompt = TRANSLATE_PROMPT
     history = [{"role": "system", "content": sys_prompt}]
     translated, _ = query(prompt=sentence+"/no_think", history=history,
-                          url=qwen3_endpoint)
+                          url=qwen3_endpoint, priority=priority)
     translated = translated.split("</think>")[-1].strip()
     return translated
 
 
-def get_emotion(sentence: str, history: list[dict] = []):
-    print(f"emotion >> {len(history)}")
-    sys_prompt = f"你是一个情感分析助手，负责分析“丛雨”说的话的情感。你现在需要将用户输入的句子进行分析，综合用户的输入和丛雨的输出返回一个丛雨情感的标签。所有供你参考的标签有{'，'.join(os.listdir('./models/Murasame_SoVITS/reference_voices'))}。你需要直接返回情感标签，不需要其他任何内容。"
+def emotion_labels():
+    """可用的情感标签，即参考音频目录下的子目录名"""
+    return os.listdir('./models/Murasame_SoVITS/reference_voices')
+
+
+def get_emotion(sentence: str, history: list[dict] = [], priority: str = "interactive"):
+    client.log(f"emotion >> {len(history)}")
+    sys_prompt = emotion_prompt(emotion_labels())
     if history == []:
         history = [{"role": "system", "content": sys_prompt}]
     if history[0]["role"] != "system":
         history = [{"role": "system", "content": sys_prompt}] + history
+    # 优先按似然从标签中直接选择，只需服务端一次 prefill
+    try:
+        response_json = client.post(classify_endpoint, json={
+            "prompt": sentence+"/no_think",
+            "history": history,
+            "labels": emotion_labels(),
+            "priority": priority
+        }).json()
+        _check_aborted(response_json, priority)
+        if response_json.get("status", 200) != 200:
+            raise Exception(response_json.get("response"))
+        return response_json["response"], response_json["history"]
+    except (RequestDropped, RequestCancelled):
+        raise
+    except Exception as e:
+        print(f"classify failed, falling back to generation: {e}")
     emotion, history = query(prompt=sentence+"/no_think", history=history,
-                             url=qwen3_endpoint)
+                             url=qwen3_endpoint,
+                             constraint={"type": "choice", "options": emotion_labels()},
+                             priority=priority)
     emotion = emotion.split("</think>")[-1].strip()
-    if emotion not in os.listdir('./models/Murasame_SoVITS/reference_voices'):
+    if emotion not in emotion_labels():
         print(f"??? {emotion} not in reference voices")
         emotion = "平静"
     return emotion, history
 
 
-def get_embedings_layers(response: str, type: str, history: list[dict] = []):
+def get_embedings_layers(response: str, type: str, history: list[dict] = [], priority: str = "interactive"):
     assert type in ['a', 'b']
-    print(f"embeddings >> {len(history)}")
-    if type == 'a':
-        sysprompt = '''你是一个立绘图层生成助手。用户会提供一个句子，你需要根据句子的情感来生成一张说话人的立绘所需的图层列表。你需要根据句子的感情来选择图层，供你参考的图层有：
-基础人物 >> 1957：睡衣，双手插在腰间；1956：睡衣，两手自然下垂；1979：便衣1，双手插在腰间；1978：便衣1，两手自然下垂；1953：校服，双手插在腰间；1952：校服，两手自然下垂；1951：便衣2，双手插在腰间；1950：便衣2，两手自然下垂；
-表情 >> 1996：惊奇，闭着嘴（泪）；1995：伤心，眼睛看向镜头（泪）；1994：伤心，眼睛看向别处（泪）；1993：叹气（泪）；1992：欣慰（泪）；1991：高兴（泪）；2009：高兴，闭眼（泪）；1989：失望，闭眼（泪）；1988：叹气，眼睛看向别处（泪）；1987：害羞，腼腆（泪）；1986：惊奇，张着嘴（泪）；1976：困惑，真挚；1975：疑惑，愣住；1974：愣住，焦急，真挚；1973：愤怒，困惑；1972：困惑，羞涩；1971：寂寞 ，羞涩；1970：真挚，寂寞，思考；1969：困惑，愣住，羞涩；1968：困惑，寂寞，羞涩；1967：困惑；1966：困惑，笑容，羞涩；1965：笑容，困惑；1964：笑容；1963：笑容；1935：紧张；1904：嘿嘿嘿；1880：达观；1856：恐惧；1822：严肃；1801：超级不满；1768：极度不满；1738：孩子气；1714：疑惑；1690：愣住；1668：窃笑2；1644：窃笑；1620：愤怒；1596：困惑；1572：思考；1548：真挚；1528：寂寞；1504：羞涩2；1480：羞涩；1455：腼腆；1430：焦急2；1399：焦急；1368：惊讶；1337：愣住；1316：笑容1；1292：平静
-额外装饰 >> 1940：叹气的装饰；1958：腮红（有些害羞）
-头发 >> 1273：穿便衣2时必选的图层；1959：穿除便衣2时必选的图层
-
-以上是你可以选择的图层，基础人物、表情、头发中必须各选一个，额外装饰可以多选，也可以都不选。但是你返回的图层顺序必须是基础人物在最前，之后是表情，之后是额外装饰，最后是头发。
-返回请给出一个JSON列表，里面放上图层ID，例如"[1953, 1801, 1959]"。你不需要返回markdown格式的JSON，你也不需要加入```json这样的内容，你只需要返回纯文本即可。'''
-    else:
-        sysprompt = '''你是一个立绘图层生成助手。用户会提供一个句子，你需要根据句子的情感来生成一张说话人的立绘所需的图层列表。你需要根据句子的感情来选择图层，供你参考的图层有：
-基础人物 >> 1718：睡衣；1717：便衣；1716：校服；1715：便衣2
-表情 >> 1755：伤心（泪）；1754：有些生气，指责（泪）；1753：闭眼（泪）；1752：害羞（泪）；1751：失落（泪）；1750：欣慰，高兴（泪）；1749：高兴（泪）；1748：欣慰，高兴，闭眼（泪）；1747：惊奇（泪）；1787：大哭；1765：大哭2；1745：高兴2（泪）；1733：悲伤，害羞；1732：撒娇，愤怒尖叫，眯眼；1731：愤怒尖叫，认真，惊讶；1730：愤怒尖叫，悲伤，认真；1729：悲伤，撒娇，抬眼；1728：悲伤，害羞，认真；1727：惊讶，基础，抬眼；1726：悲伤；1725：悲伤，笑脸2，微笑；1724：笑脸2，眯眼；1723：悲伤；1722：笑脸2，微笑；1721：笑脸2；1704：达观；1681：认真脸2；1710：超级生气；1641：愤怒尖叫；1616：抬眼，害羞；1712：不满，哼哼唧唧2；1711：不满，哼哼唧唧；1524：认真；1505：瞪大眼睛，惊讶；1475：撒娇；1452：眯眼；1429：悲伤；1406：害羞；1376：惊讶；1352：微笑；1329：笑脸2；1306：平静
-额外装饰 >> 1708：不满时脸色阴沉的装饰；1719：腮红（有些害羞）
-头发 >> 1261：头发（必选）
-
-以上是你可以选择的图层，基础人物、表情、头发中必须各选一个，额外装饰可以多选，也可以都不选。但是你返回的图层顺序必须是基础人物在最前，之后是表情，之后是额外装饰，最后是头发。
-返回请给出一个JSON列表，里面放上图层ID，例如"[1718, 1475, 1261]"。你不需要返回markdown格式的JSON，你也不需要加入```json这样的内容，你只需要返回纯文本即可。'''
+    client.log(f"embeddings >> {len(history)}")
+    sysprompt = layer_prompt(type)
     if history == []:
         history = [{"role": "system", "content": sysprompt}]
     if history[0]["role"] != "system":
         history = [{"role": "system", "content": sysprompt}] + history
     embeddings_layers, history = query(prompt=response+"/no_think", history=history,
-                                       url=qwen3_endpoint)
+                                       url=qwen3_endpoint,
+                                       constraint={"type": "layers", "variant": type},
+                                       priority=priority)
     embeddings_layers = embeddings_layers.split("</think>")[-1].strip()
     embeddings_layers = format_bot_response(embeddings_layers)
     if not isinstance(embeddings_layers, list):
@@ -194,8 +334,28 @@ def get_embedings_layers(response: str, type: str, history: list[dict] = []):
     return embeddings_layers, history
 
 
-def generate_tts(sentence: str, emotion):
+def get_postprocess(prompt: str, response: str, type: str = "b", priority: str = "interactive", request_id: str = None):
+    """一次请求同时得到回复的日文翻译、情感标签与立绘图层，返回 (translated, emotion, layers)"""
+    assert type in ['a', 'b']
+    payload = {
+        "prompt": prompt,
+        "response": response,
+        "type": type,
+        "emotions": emotion_labels(),
+        "priority": priority
+    }
+    if request_id is not None:
+        payload["request_id"] = request_id
+    response_json = client.post(postprocess_endpoint, json=payload).json()
+    _check_aborted(response_json, priority)
+    if response_json.get("status", 200) != 200:
+        raise Exception(f"Postprocess API error. Status: {response_json.get('status')}, Response: {response_json.get('response')}")
+    client.log(f"postprocess >> {response_json.get('mode')}")
+    return response_json["translation"], response_json["emotion"], response_json["layers"]
+
 
+def tts_params(sentence: str, emotion):
+    """GPT-SoVITS /tts 的请求参数，同时作为语音缓存的键"""
     audio = os.listdir(f"./models/Murasame_SoVITS/reference_voices/{emotion}")
     audio.remove("asr.txt")
     with open(f"./models/Murasame_SoVITS/reference_voices/{emotion}/asr.txt", "r", encoding="utf-8") as f:
@@ -212,16 +372,91 @@ def generate_tts(sentence: str, emotion):
         "top_p": 1,
         "temperature": 1,
         "speed_factor": 1.0,
+        # 固定种子时同一句话每次合成的结果相同；-1 为随机
+        "seed": int(tts_config.get('seed', -1)),
     }
-    response = requests.post(
-        murasame_sovits_endpoint, json=params)
-    sentence_md5 = hashlib.md5(sentence.encode()).hexdigest()
-    voices_dir = os.path.join(os.getcwd(), 'voices')
-    os.makedirs(voices_dir, exist_ok=True)
-    voice_path = os.path.join(voices_dir, f"{sentence_md5}.wav")
-    with open(voice_path, "wb") as f:
-        f.write(response.content)
-    return sentence_md5
+    return params
+
+
+def get_tts_cache():
+    """返回语音缓存，首次调用时创建；cache_dir 为空时返回 None"""
+    global tts_cache
+    directory = tts_config.get('cache_dir', './voices')
+    if not directory:
+        return None
+    with _tts_cache_lock:
+        if tts_cache is None:
+            tts_cache = TTSCache(
+                directory=directory,
+                max_bytes=int(tts_config.get('cache_max_mb', 512)) * 1024 * 1024,
+            )
+            # 退出时保存命中后更新的最近使用时间
+            atexit.register(tts_cache.flush)
+    return tts_cache
+
+
+def generate_tts(sentence: str, emotion) -> bytes:
+    """合成语音并返回 wav 数据；相同参数合成过的语音直接从缓存读取，不请求 TTS 服务，新合成的语音顺带写入缓存"""
+    params = tts_params(sentence, emotion)
+    key = synthesis_key(params)
+    tts_cache = get_tts_cache()
+    if tts_cache is not None:
+        data = tts_cache.get(key)
+        if data is not None:
+            client.log(f"tts cache hit >> {sentence[:20]}")
+            return data
+    response = client.post(
+        murasame_sovits_endpoint, route="tts", json=params)
+    if response.status_code != 200:
+        raise Exception(f"TTS API error. Status: {response.status_code}, Response: {response.text[:500]}")
+    if tts_cache is not None:
+        tts_cache.put(key, response.content, text=sentence)
+    return response.content
+
+
+# 句末标点；紧跟其后的标点与右引号、右括号归入同一句
+SENTENCE_ENDINGS = "。！？!?…~～\n"
+SENTENCE_CLOSERS = "」』）)”’\"'"
+
+
+class SentenceBuffer:
+    """累积流式回复的片段，每凑齐一个完整的句子就返回，用于逐句翻译与合成语音
+
+    句末标点之后出现其他字符时才确认句子结束，避免把 "……" 或 "！？" 拆开；
+    不足 min_chars 个字符的短句与下一句合并。
+    """
+
+    def __init__(self, min_chars: int = 4):
+        self.min_chars = min_chars
+        self.text = ""
+
+    def feed(self, piece: str) -> list[str]:
+        self.text += piece
+        sentences = []
+        start = 0
+        index = 0
+        while index < len(self.text):
+            if self.text[index] not in SENTENCE_ENDINGS:
+                index += 1
+                continue
+            end = index
+            while end < len(self.text) and self.text[end] in SENTENCE_ENDINGS + SENTENCE_CLOSERS:
+                end += 1
+            if end == len(self.text):
+                # 后面可能还有标点，等待下一个片段
+                break
+            sentence = self.text[start:end].strip()
+            if len(sentence) >= self.min_chars:
+                sentences.append(sentence)
+                start = end
+            index = end
+        self.text = self.text[start:]
+        return sentences
+
+    def flush(self) -> list[str]:
+        """回复结束时取出剩余的文本"""
+        sentence, self.text = self.text.strip(), ""
+        return [sentence] if sentence else []
 
 
 from typing import Any
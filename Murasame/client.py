@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""
+客户端 HTTP 层
+chat.py 的请求共用按服务地址划分的 requests.Session：保持长连接、按路由设置超时，调试日志默认关闭
+"""
+
+import threading
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from .utils import get_config
+
+http_config = get_config().get('user', {}).get('http', {})
+connect_timeout = float(http_config.get('connect_timeout', 5))
+# {路由名: 读取超时秒数}；流式请求的读取超时是两次收到数据之间的最长间隔
+read_timeouts = http_config.get('timeouts', {})
+default_read_timeout = float(http_config.get('default_timeout', 120))
+pool_size = int(http_config.get('pool_size', 8))
+verbose = bool(http_config.get('verbose', False))
+
+_sessions = {}
+_lock = threading.Lock()
+
+
+def session_for(url):
+    """按 scheme://host:port 复用 Session，每个服务各自维护一个连接池"""
+    parts = urlsplit(url)
+    base = f"{parts.scheme}://{parts.netloc}"
+    with _lock:
+        session = _sessions.get(base)
+        if session is None:
+            session = requests.Session()
+            # 翻译、情感、图层等请求会并发发出，连接池需要容纳它们
+            session.mount(f"{parts.scheme}://", HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+            _sessions[base] = session
+    return session
+
+
+def timeout_for(url, route=None):
+    """(连接超时, 读取超时)；route 默认取 URL 路径的最后一段，例如 chat、qwen3、tts"""
+    route = route or urlsplit(url).path.rstrip("/").rsplit("/", 1)[-1]
+    return connect_timeout, float(read_timeouts.get(route, default_read_timeout))
+
+
+def post(url, route=None, **kwargs):
+    kwargs.setdefault("timeout", timeout_for(url, route))
+    return session_for(url).post(url, **kwargs)
+
+
+def delete(url, route=None, **kwargs):
+    kwargs.setdefault("timeout", timeout_for(url, route))
+    return session_for(url).delete(url, **kwargs)
+
+
+def log(message):
+    """调试日志：仅在 user.http.verbose 为 true 时输出"""
+    if verbose:
+        print(message)
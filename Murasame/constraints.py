@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""
+受限解码
+把输出限制在一组合法字符串之内（情感标签、立绘图层列表），通过 logits processor 屏蔽其余 token
+"""
+
+import torch
+
+from .prompts import layer_options
+
+
+def resolve_options(constraint):
+    """把请求中的 constraint 转换为合法输出字符串列表
+
+    支持 {"type": "choice", "options": [...]} 与 {"type": "layers", "variant": "a" | "b"}。
+    """
+    if not isinstance(constraint, dict):
+        raise ValueError(f"无效的 constraint: {constraint}")
+    kind = constraint.get('type')
+    if kind == 'choice':
+        options = [str(option) for option in constraint.get('options', []) if str(option)]
+    elif kind == 'layers':
+        options = layer_options(constraint.get('variant', 'b'))
+    else:
+        raise ValueError(f"未知的 constraint 类型: {kind}")
+    if not options:
+        raise ValueError("constraint 没有可选的输出")
+    return options
+
+
+class AllowedSequences:
+    """合法输出的 token 前缀树
+
+    allowed(generated) 返回在已生成 token 之后允许出现的下一个 token；
+    一个完整的选项生成完毕后只允许结束符。
+    """
+
+    _END = -1
+
+    def __init__(self, tokenizer, options, eos_token_ids):
+        self.options = list(options)
+        self.eos_token_ids = sorted({i for i in eos_token_ids if i is not None})
+        self.max_length = 0
+        self._root = {}
+        for option in self.options:
+            ids = tokenizer.encode(option, add_special_tokens=False)
+            self.max_length = max(self.max_length, len(ids))
+            node = self._root
+            for token in ids:
+                node = node.setdefault(token, {})
+            node[self._END] = True
+
+    def allowed(self, generated):
+        node = self._root
+        for token in generated:
+            if token in self.eos_token_ids:
+                break
+            node = node.get(token)
+            if node is None:
+                # 不应出现：已生成内容偏离了前缀树，只允许结束
+                return self.eos_token_ids
+        allowed = [token for token in node if token != self._END]
+        if self._END in node:
+            allowed.extend(self.eos_token_ids)
+        return allowed
+
+    def mask(self, scores, generated):
+        """对单行 logits 屏蔽不允许的 token"""
+        allowed = torch.tensor(self.allowed(generated), device=scores.device)
+        masked = torch.full_like(scores, float("-inf"))
+        masked[allowed] = scores[allowed]
+        return masked
+
+
+class ConstrainedLogitsProcessor:
+    """供 model.generate 使用的 logits processor（首次调用时记录提示词长度）"""
+
+    def __init__(self, constraint):
+        self.constraint = constraint
+        self.prompt_length = None
+
+    def __call__(self, input_ids, scores):
+        if self.prompt_length is None:
+            self.prompt_length = input_ids.shape[-1]
+        for row in range(scores.shape[0]):
+            generated = input_ids[row, self.prompt_length:].tolist()
+            scores[row] = self.constraint.mask(scores[row], generated)
+        return scores
+
+
+def mlx_logits_processor(constraint):
+    """供 mlx_lm 使用的 logits processor：processor(tokens, logits) -> logits
+
+    mlx_lm 分块 prefill 时传入的 tokens 不一定包含完整提示词，因此同样以首次调用时的长度作为生成起点。
+    """
+    import mlx.core as mx
+    import numpy as np
+
+    prompt_length = None
+
+    def processor(tokens, logits):
+        nonlocal prompt_length
+        if prompt_length is None:
+            prompt_length = tokens.size
+        generated = tokens[prompt_length:].tolist()
+        mask = np.full(logits.shape[-1], -np.inf, dtype=np.float32)
+        mask[constraint.allowed(generated)] = 0.0
+        return logits + mx.array(mask)
+
+    return processor
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+对话历史压缩
+按 token 预算裁剪历史：保留开头的系统提示词和最近的若干轮，被移出的消息可折叠进一条滚动摘要
+"""
+
+# 摘要消息以此开头，用于在后续轮次中识别并替换
+SUMMARY_TAG = "【更早对话的摘要】"
+
+# 单条消息在聊天模板中的额外开销（<|im_start|>role\n ... <|im_end|>\n）
+MESSAGE_OVERHEAD = 5
+
+
+def count_tokens(tokenizer, history):
+    """按聊天模板渲染后的实际 token 数"""
+    text = tokenizer.apply_chat_template(
+        history,
+        tokenize=False,
+        add_generation_prompt=True,
+        enable_thinking=False,
+    )
+    return len(tokenizer.encode(text))
+
+
+def _message_tokens(tokenizer, message):
+    content = message.get('content', '')
+    if not isinstance(content, str):
+        content = str(content)
+    return len(tokenizer.encode(content)) + MESSAGE_OVERHEAD
+
+
+def is_summary(message):
+    return message.get('role') == 'system' and str(message.get('content', '')).startswith(SUMMARY_TAG)
+
+
+def compact_history(history, tokenizer, budget, target_ratio=0.75, reserve=0, prompt_tokens=None):
+    """把 history 压缩到 budget 个 token 以内
+
+    一旦超出预算，就从最早的轮次开始整轮移除，直到降到 budget * target_ratio 以下，
+    这样不会在预算边缘每一轮都触发压缩（也不会每轮都打断前缀缓存）。
+    开头的系统提示词（人设，即 history[0]）和最后一条消息（本轮输入）始终保留；之后的 system 消息
+    （例如客户端每轮附带的当前时间）属于所在的轮次，随该轮一起移除。reserve 为预留给摘要的 token 数。
+    调用方已渲染过提示词时可通过 prompt_tokens 传入其 token 数，不再重新渲染。
+
+    返回 (压缩后的历史, 被移出的消息, 已有的摘要文本或 None)
+    """
+    if prompt_tokens is None:
+        prompt_tokens = count_tokens(tokenizer, history)
+    if prompt_tokens <= budget:
+        return history, [], None
+
+    head = []
+    if history and history[0].get('role') == 'system' and not is_summary(history[0]):
+        head.append(history[0])
+    summary = None
+    body = []
+    for message in history[len(head):]:
+        if is_summary(message):
+            summary = message['content'][len(SUMMARY_TAG):]
+        else:
+            body.append(message)
+
+    target = int(budget * target_ratio) - reserve
+    costs = [_message_tokens(tokenizer, message) for message in body]
+    total = sum(_message_tokens(tokenizer, message) for message in head) + sum(costs)
+    if summary is not None:
+        total += len(tokenizer.encode(summary)) + MESSAGE_OVERHEAD
+
+    evicted = []
+    while total > target and len(body) > 1:
+        # 整轮移除：一轮为连续的输入消息（时间等 system 消息、用户消息）加上其后的回复
+        while len(body) > 1 and body[0].get('role') != 'assistant':
+            evicted.append(body.pop(0))
+            total -= costs.pop(0)
+        while len(body) > 1 and body[0].get('role') == 'assistant':
+            evicted.append(body.pop(0))
+            total -= costs.pop(0)
+
+    compacted = head + ([summary_message(summary)] if summary else []) + body
+    return compacted, evicted, summary
+
+
+def summary_message(summary):
+    return {"role": "system", "content": f"{SUMMARY_TAG}{summary}"}
+
+
+def with_summary(history, summary):
+    """在系统提示词（history[0]）之后插入（或替换）滚动摘要"""
+    rest = [message for message in history if not is_summary(message)]
+    index = 1 if rest and rest[0].get('role') == 'system' else 0
+    return rest[:index] + [summary_message(summary)] + rest[index:]
+
+
+def format_transcript(messages):
+    """把消息列表转为摘要模型可读的对话文本"""
+    names = {"user": "主人", "assistant": "丛雨", "system": "系统"}
+    return "\n".join(f"{names.get(m.get('role'), m.get('role'))}：{m.get('content', '')}" for m in messages)
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""
+KV 缓存工具
+提供 KV 缓存格式转换，以及按 token 前缀复用 KV 的前缀缓存
+"""
+
+import threading
+from collections import OrderedDict
+
+import torch
+from transformers import DynamicCache
+
+
+def to_legacy_cache(cache):
+    """把模型返回的 KV 缓存统一转换为 ((key, value), ...) 元组"""
+    if cache is None or isinstance(cache, tuple):
+        return cache
+    if hasattr(cache, "to_legacy_cache"):
+        return cache.to_legacy_cache()
+    return tuple((layer.keys, layer.values) for layer in cache.layers)
+
+
+def from_legacy_cache(past):
+    """把 ((key, value), ...) 元组包装成模型可接受的 DynamicCache
+
+    DynamicCache 追加新 token 时会生成新的张量，因此传入的元组本身不会被修改，可以安全地重复使用。
+    """
+    if past is None:
+        return None
+    if hasattr(DynamicCache, "from_legacy_cache"):
+        return DynamicCache.from_legacy_cache(past)
+    cache = DynamicCache()
+    for layer_idx, (key, value) in enumerate(past):
+        cache.update(key, value, layer_idx)
+    return cache
+
+
+def slice_cache(past, length):
+    """截取 KV 缓存的前 length 个位置，并复制出独立的张量"""
+    return tuple(
+        (key[:, :, :length].clone(), value[:, :, :length].clone())
+        for key, value in past
+    )
+
+
+def cache_nbytes(past):
+    """KV 缓存占用的字节数"""
+    if past is None:
+        return 0
+    return sum(key.numel() * key.element_size() + value.numel() * value.element_size()
+               for key, value in past)
+
+
+def adapter_kwargs(model, adapter_names):
+    """PEFT 按行选择适配器的参数；全部使用默认适配器 (None) 时不传，走普通前向路径
+
+    PEFT 通过在 LoRA 层上临时注册前向钩子实现按行选择，带该参数的前向计算不能与其他前向计算并发执行。
+    """
+    if all(name is None for name in adapter_names):
+        return {}
+    default = getattr(model, "active_adapter", "default")
+    return {"adapter_names": [default if name is None else name for name in adapter_names]}
+
+
+def compute_prefix_cache(model, input_ids, device, adapter_name=None):
+    """对一段前缀做一次前向计算，返回它的 KV 缓存"""
+    with torch.no_grad():
+        ids = torch.tensor([list(input_ids)], device=device)
+        outputs = model(
+            input_ids=ids,
+            attention_mask=torch.ones_like(ids),
+            use_cache=True,
+            logits_to_keep=1,
+            **adapter_kwargs(model, [adapter_name]),
+        )
+    return to_legacy_cache(outputs.past_key_values)
+
+
+class PrefixCache:
+    """按 token 前缀保存 KV 缓存（LRU）
+
+    固定的系统提示词（如丛雨人设、各个辅助提示词）只需要 prefill 一次，
+    之后以它开头的请求直接复用缓存，只计算剩余部分。
+    启用与禁用 LoRA 适配器时同一前缀的 KV 并不相同，因此缓存按 namespace（适配器名）分开保存。
+    """
+
+    def __init__(self, max_entries=8):
+        self.max_entries = max(1, int(max_entries))
+        self.hits = 0
+        self.misses = 0
+        self.reused_tokens = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, prefix_ids):
+        return (None, tuple(prefix_ids)) in self._entries
+
+    def lookup(self, input_ids, namespace=None):
+        """查找 input_ids 的最长已缓存前缀，返回 (前缀长度, KV 缓存)；未命中时返回 (0, None)
+
+        前缀必须严格短于 input_ids，保证至少还有一个 token 需要前向计算以得到 logits。
+        """
+        input_ids = tuple(input_ids)
+        with self._lock:
+            best = None
+            for key in self._entries:
+                entry_namespace, prefix = key
+                if entry_namespace != namespace:
+                    continue
+                if len(prefix) < len(input_ids) and input_ids[:len(prefix)] == prefix:
+                    if best is None or len(prefix) > len(best[1]):
+                        best = key
+            if best is None:
+                self.misses += 1
+                return 0, None
+            self._entries.move_to_end(best)
+            self.hits += 1
+            self.reused_tokens += len(best[1])
+            return len(best[1]), self._entries[best]
+
+    def store(self, prefix_ids, past, namespace=None):
+        with self._lock:
+            key = (namespace, tuple(prefix_ids))
+            self._entries[key] = past
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "reused_tokens": self.reused_tokens,
+            "bytes": sum(cache_nbytes(past) for past in self._entries.values()),
+        }
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+"""
+合并权重缓存 (PyTorch 引擎)
+把 LoRA 适配器合并进基础模型并保存为分片 safetensors，之后启动时直接加载合并后的模型
+"""
+
+import hashlib
+import json
+import os
+import shutil
+
+MARKER_FILE = "murasame_merged.json"
+
+
+def merged_fingerprint(adapter_path, base_model_path):
+    """由适配器配置、适配器权重文件和基础模型路径计算指纹，任何一项变化都会使缓存失效"""
+    digest = hashlib.sha256()
+    digest.update(os.path.abspath(base_model_path).encode("utf-8"))
+    for name in sorted(os.listdir(adapter_path)):
+        file_path = os.path.join(adapter_path, name)
+        if not os.path.isfile(file_path):
+            continue
+        if name == "adapter_config.json":
+            with open(file_path, "rb") as f:
+                digest.update(f.read())
+        elif name.startswith("adapter_model"):
+            stat = os.stat(file_path)
+            digest.update(f"{name}:{stat.st_size}:{int(stat.st_mtime)}".encode("utf-8"))
+    return digest.hexdigest()
+
+
+def is_merged_cache_valid(merged_path, fingerprint):
+    marker_path = os.path.join(merged_path, MARKER_FILE)
+    if not os.path.exists(marker_path):
+        return False
+    try:
+        with open(marker_path, "r", encoding="utf-8") as f:
+            return json.load(f).get("fingerprint") == fingerprint
+    except (OSError, ValueError):
+        return False
+
+
+def materialize_merged(model, tokenizer, merged_path, fingerprint, max_shard_size="2GB"):
+    """合并 LoRA 并写出分片 safetensors，返回合并后的模型
+
+    先写入临时目录，全部完成后再替换目标目录，避免中断时留下不完整的缓存。
+    """
+    merged = model.merge_and_unload()
+    tmp_path = f"{merged_path}.tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    merged.save_pretrained(tmp_path, safe_serialization=True, max_shard_size=max_shard_size)
+    tokenizer.save_pretrained(tmp_path)
+    with open(os.path.join(tmp_path, MARKER_FILE), "w", encoding="utf-8") as f:
+        json.dump({"fingerprint": fingerprint}, f)
+    shutil.rmtree(merged_path, ignore_errors=True)
+    os.replace(tmp_path, merged_path)
+    return merged
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+"""
+运行指标
+进程内的计数器与直方图，以 Prometheus 文本格式通过 /metrics 导出；可以在推理线程中调用
+"""
+
+import threading
+import time
+
+# 耗时类直方图的默认桶（秒）
+DEFAULT_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+RATE_BUCKETS = (1, 2, 5, 10, 20, 30, 50, 75, 100, 200)
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values)) + (extra or [])
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+def _format_value(value):
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Counter:
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # 每组标签: [各桶计数..., 总次数, 总和]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            state = self._values.setdefault(key, [0] * len(self.buckets) + [0, 0.0])
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[index] += 1
+            state[-2] += 1
+            state[-1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, state in sorted(self._values.items()):
+                for bound, count in zip(self.buckets, state):
+                    labels = _format_labels(self.labelnames, key, [("le", _format_value(bound))])
+                    lines.append(f"{self.name}_bucket{labels} {count}")
+                labels = _format_labels(self.labelnames, key, [("le", "+Inf")])
+                lines.append(f"{self.name}_bucket{labels} {state[-2]}")
+                lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {state[-2]}")
+                lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {state[-1]:.6f}")
+        return lines
+
+
+class Gauge:
+    """在导出时调用 fn() 取值；fn 返回数值，或 {标签值元组: 数值}"""
+
+    def __init__(self, name, help, fn, labelnames=()):
+        self.name = name
+        self.help = help
+        self.fn = fn
+        self.labelnames = tuple(labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        value = self.fn()
+        items = value.items() if isinstance(value, dict) else [((), value)]
+        for key, item in items:
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(item)}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+REQUESTS = REGISTRY.register(Counter(
+    "murasame_requests_total", "按路由与状态码统计的请求数", ("route", "status")))
+REQUEST_SECONDS = REGISTRY.register(Histogram(
+    "murasame_request_duration_seconds", "请求总耗时（流式请求包含全部输出）", ("route",)))
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    "murasame_stage_duration_seconds",
+    "本地推理各阶段耗时：queue_wait 排队、prefill 提示词计算、ttft 从入队到首个 token、decode 解码", ("route", "stage")))
+GENERATED_TOKENS = REGISTRY.register(Counter(
+    "murasame_generated_tokens_total", "本地模型生成的 token 数", ("route",)))
+DECODE_RATE = REGISTRY.register(Histogram(
+    "murasame_decode_tokens_per_second", "每个请求的解码速度", ("route",), buckets=RATE_BUCKETS))
+UPSTREAM_SECONDS = REGISTRY.register(Histogram(
+    "murasame_upstream_duration_seconds", "上游 (Ollama / OpenRouter) 单次 HTTP 调用耗时", ("backend", "outcome")))
+
+
+class MetricsMiddleware:
+    """ASGI 中间件：按路由模板统计请求数、状态码与总耗时"""
+
+    def __init__(self, app, exclude=("/metrics",)):
+        self.app = app
+        self.exclude = set(exclude)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        start = time.perf_counter()
+        status = [500]
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            # 路由匹配后 FastAPI 会在 scope 中写入 route，未匹配的路径不做统计
+            route = getattr(scope.get("route"), "path", None)
+            if route is not None and route not in self.exclude:
+                REQUESTS.inc(route=route, status=status[0])
+                REQUEST_SECONDS.observe(time.perf_counter() - start, route=route)
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""
+辅助模型提示词
+翻译、情感分析与立绘图层生成的系统提示词，由客户端 (chat.py) 与服务端 (api.py) 共用
+"""
+
+import itertools
+import json
+import re
+
+TRANSLATE_PROMPT = "你是一个翻译助手，负责将用户输入的中文翻译成日文。要求：要将中文的“本座”翻译为“吾輩（わがはい）”；将“主人翻译为“ご主人（ごしゅじん）”；将“丛雨”翻译为“ムラサメ”；“小雨”则是丛雨的昵称，翻译为“ムラサメちゃん”。且日文要有强烈的古日语风格。你只需要返回翻译即可，不需要对其中的日文汉字进行注音。"
+
+# 立绘图层目录：a 为ムラサメa，b 为ムラサメb
+LAYER_CATALOGS = {
+    'a': '''基础人物 >> 1957：睡衣，双手插在腰间；1956：睡衣，两手自然下垂；1979：便衣1，双手插在腰间；1978：便衣1，两手自然下垂；1953：校服，双手插在腰间；1952：校服，两手自然下垂；1951：便衣2，双手插在腰间；1950：便衣2，两手自然下垂；
+表情 >> 1996：惊奇，闭着嘴（泪）；1995：伤心，眼睛看向镜头（泪）；1994：伤心，眼睛看向别处（泪）；1993：叹气（泪）；1992：欣慰（泪）；1991：高兴（泪）；2009：高兴，闭眼（泪）；1989：失望，闭眼（泪）；1988：叹气，眼睛看向别处（泪）；1987：害羞，腼腆（泪）；1986：惊奇，张着嘴（泪）；1976：困惑，真挚；1975：疑惑，愣住；1974：愣住，焦急，真挚；1973：愤怒，困惑；1972：困惑，羞涩；1971：寂寞 ，羞涩；1970：真挚，寂寞，思考；1969：困惑，愣住，羞涩；1968：困惑，寂寞，羞涩；1967：困惑；1966：困惑，笑容，羞涩；1965：笑容，困惑；1964：笑容；1963：笑容；1935：紧张；1904：嘿嘿嘿；1880：达观；1856：恐惧；1822：严肃；1801：超级不满；1768：极度不满；1738：孩子气；1714：疑惑；1690：愣住；1668：窃笑2；1644：窃笑；1620：愤怒；1596：困惑；1572：思考；1548：真挚；1528：寂寞；1504：羞涩2；1480：羞涩；1455：腼腆；1430：焦急2；1399：焦急；1368：惊讶；1337：愣住；1316：笑容1；1292：平静
+额外装饰 >> 1940：叹气的装饰；1958：腮红（有些害羞）
+头发 >> 1273：穿便衣2时必选的图层；1959：穿除便衣2时必选的图层''',
+    'b': '''基础人物 >> 1718：睡衣；1717：便衣；1716：校服；1715：便衣2
+表情 >> 1755：伤心（泪）；1754：有些生气，指责（泪）；1753：闭眼（泪）；1752：害羞（泪）；1751：失落（泪）；1750：欣慰，高兴（泪）；1749：高兴（泪）；1748：欣慰，高兴，闭眼（泪）；1747：惊奇（泪）；1787：大哭；1765：大哭2；1745：高兴2（泪）；1733：悲伤，害羞；1732：撒娇，愤怒尖叫，眯眼；1731：愤怒尖叫，认真，惊讶；1730：愤怒尖叫，悲伤，认真；1729：悲伤，撒娇，抬眼；1728：悲伤，害羞，认真；1727：惊讶，基础，抬眼；1726：悲伤；1725：悲伤，笑脸2，微笑；1724：笑脸2，眯眼；1723：悲伤；1722：笑脸2，微笑；1721：笑脸2；1704：达观；1681：认真脸2；1710：超级生气；1641：愤怒尖叫；1616：抬眼，害羞；1712：不满，哼哼唧唧2；1711：不满，哼哼唧唧；1524：认真；1505：瞪大眼睛，惊讶；1475：撒娇；1452：眯眼；1429：悲伤；1406：害羞；1376：惊讶；1352：微笑；1329：笑脸2；1306：平静
+额外装饰 >> 1708：不满时脸色阴沉的装饰；1719：腮红（有些害羞）
+头发 >> 1261：头发（必选）''',
+}
+
+LAYER_EXAMPLES = {
+    'a': "[1953, 1801, 1959]",
+    'b': "[1718, 1475, 1261]",
+}
+
+LAYER_RULES = "以上是你可以选择的图层，基础人物、表情、头发中必须各选一个，额外装饰可以多选，也可以都不选。但是你返回的图层顺序必须是基础人物在最前，之后是表情，之后是额外装饰，最后是头发。"
+
+
+def layer_groups(type):
+    """解析图层目录，返回 {分组名: [图层ID, ...]}"""
+    groups = {}
+    for line in LAYER_CATALOGS[type].splitlines():
+        name, _, items = line.partition(" >> ")
+        ids = [int(layer) for layer in re.findall(r"(\d+)：", items)]
+        groups[name.strip()] = list(dict.fromkeys(ids))
+    return groups
+
+
+def hair_layer(type, base):
+    # ムラサメa 穿便衣2 (1950/1951) 时使用 1273，其余使用 1959；ムラサメb 只有一种头发
+    if type == 'a':
+        return 1273 if base in (1950, 1951) else 1959
+    return 1261
+
+
+def layer_options(type):
+    """所有合法的图层列表（JSON 文本）：基础人物、表情、按顺序的若干额外装饰、与基础人物匹配的头发"""
+    groups = layer_groups(type)
+    decorations = groups["额外装饰"]
+    options = []
+    for base in groups["基础人物"]:
+        for expression in groups["表情"]:
+            for count in range(len(decorations) + 1):
+                for extra in itertools.combinations(decorations, count):
+                    options.append(json.dumps([base, expression, *extra, hair_layer(type, base)]))
+    return options
+
+
+def emotion_prompt(labels):
+    return f"你是一个情感分析助手，负责分析“丛雨”说的话的情感。你现在需要将用户输入的句子进行分析，综合用户的输入和丛雨的输出返回一个丛雨情感的标签。所有供你参考的标签有{'，'.join(labels)}。你需要直接返回情感标签，不需要其他任何内容。"
+
+
+def layer_prompt(type):
+    return f'''你是一个立绘图层生成助手。用户会提供一个句子，你需要根据句子的情感来生成一张说话人的立绘所需的图层列表。你需要根据句子的感情来选择图层，供你参考的图层有：
+{LAYER_CATALOGS[type]}
+
+{LAYER_RULES}
+返回请给出一个JSON列表，里面放上图层ID，例如"{LAYER_EXAMPLES[type]}"。你不需要返回markdown格式的JSON，你也不需要加入```json这样的内容，你只需要返回纯文本即可。'''
+
+
+def postprocess_prompt(labels, type):
+    """一次生成同时完成翻译、情感分析与立绘图层选择的系统提示词"""
+    return f'''你是丛雨桌宠的后处理助手。用户会提供一轮对话（用户的话与丛雨的回复），你需要针对丛雨的回复同时完成以下三项任务：
+1. translation：将丛雨的回复翻译成日文。要将中文的“本座”翻译为“吾輩（わがはい）”；将“主人”翻译为“ご主人（ごしゅじん）”；将“丛雨”翻译为“ムラサメ”；“小雨”则是丛雨的昵称，翻译为“ムラサメちゃん”。且日文要有强烈的古日语风格，不需要对其中的日文汉字进行注音。
+2. emotion：综合用户的输入和丛雨的输出，给出一个丛雨情感的标签。所有供你参考的标签有{'，'.join(labels)}，只能从中选择一个。
+3. layers：根据丛雨回复的情感，选择立绘所需的图层ID列表。供你参考的图层有：
+{LAYER_CATALOGS[type]}
+
+{LAYER_RULES}
+
+请只返回一个JSON对象，例如{{"translation": "……", "emotion": "{labels[0] if labels else '平静'}", "layers": {LAYER_EXAMPLES[type]}}}，不要返回markdown格式，也不要加入任何其他内容。'''
+
+
+def postprocess_schema(labels):
+    """后处理结果的 JSON Schema，用于约束上游模型的结构化输出（strict 模式要求声明 additionalProperties: false）"""
+    emotion = {"type": "string"}
+    if labels:
+        emotion["enum"] = list(labels)
+    return {
+        "type": "object",
+        "properties": {
+            "translation": {"type": "string"},
+            "emotion": emotion,
+            "layers": {"type": "array", "items": {"type": "integer"}},
+        },
+        "required": ["translation", "emotion", "layers"],
+        "additionalProperties": False,
+    }
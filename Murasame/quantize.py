@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+CPU 量化推理 (PyTorch 引擎)
+把合并后的模型的线性层量化为 int8 / int4 权重，并把量化结果缓存到磁盘
+"""
+
+import json
+import os
+import shutil
+import time
+
+import torch
+
+MARKER_FILE = "murasame_quantized.json"
+MODEL_FILE = "model.pt"
+QUANTIZATION_MODES = ("int8", "int4")
+
+
+def _int4_api():
+    """返回 int4 量化所需的 torchao 接口 (int4_weight_only, quantize_, Int4CPULayout)，不可用时返回 None"""
+    try:
+        from torchao.quantization import int4_weight_only, quantize_
+        from torchao.dtypes import Int4CPULayout
+    except ImportError:
+        return None
+    return int4_weight_only, quantize_, Int4CPULayout
+
+
+def resolve_mode(mode):
+    """实际可用的量化模式：int4 需要可选依赖 torchao（含 Int4CPULayout 的版本），不可用时回退到 int8"""
+    if mode == "int4" and _int4_api() is None:
+        print("⚠️ torchao 未安装或版本过旧，int4 量化不可用，回退到 int8 (pip install -U torchao)")
+        return "int8"
+    return mode
+
+
+def quantize_model(model, mode):
+    """量化模型中的 nn.Linear 层，返回 (量化后的模型, 实际使用的模式)
+
+    int8 使用 torch.ao 动态量化（权重 int8，激活按批动态量化）；
+    int4 需要可选依赖 torchao，按组量化权重，不可用时回退到 int8（与 resolve_mode 的判断一致）。
+    """
+    if mode == "int4":
+        api = _int4_api()
+        if api is None:
+            mode = "int8"
+        else:
+            int4_weight_only, quantize_, Int4CPULayout = api
+            model = model.to(torch.bfloat16)
+            quantize_(model, int4_weight_only(group_size=128, layout=Int4CPULayout()))
+            return model, mode
+    model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    return model, mode
+
+
+def _tensor_nbytes(value):
+    if isinstance(value, torch.Tensor):
+        # 量化张量的 element_size 为 1 (qint8)
+        return value.numel() * value.element_size()
+    if isinstance(value, (tuple, list)):
+        return sum(_tensor_nbytes(item) for item in value)
+    return 0
+
+
+def model_nbytes(model):
+    """模型权重占用的字节数（包含动态量化线性层打包后的权重）"""
+    return sum(_tensor_nbytes(value) for value in model.state_dict().values())
+
+
+def is_quantized_cache_valid(path, fingerprint, mode):
+    marker_path = os.path.join(path, MARKER_FILE)
+    if not os.path.exists(marker_path) or not os.path.exists(os.path.join(path, MODEL_FILE)):
+        return False
+    try:
+        with open(marker_path, "r", encoding="utf-8") as f:
+            marker = json.load(f)
+    except (OSError, ValueError):
+        return False
+    return marker.get("fingerprint") == fingerprint and marker.get("mode") == mode
+
+
+def save_quantized(model, tokenizer, path, fingerprint, mode):
+    """保存量化后的完整模型（量化层无法用 safetensors 表示，使用 torch.save）"""
+    tmp_path = f"{path}.tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    torch.save(model, os.path.join(tmp_path, MODEL_FILE))
+    tokenizer.save_pretrained(tmp_path)
+    with open(os.path.join(tmp_path, MARKER_FILE), "w", encoding="utf-8") as f:
+        json.dump({"fingerprint": fingerprint, "mode": mode}, f)
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp_path, path)
+
+
+def load_quantized(path):
+    # 仅加载本机生成的缓存文件，其中包含完整的模型对象
+    model = torch.load(os.path.join(path, MODEL_FILE), weights_only=False, mmap=True)
+    model.eval()
+    return model
+
+
+def benchmark_decode(model, tokenizer, device, new_tokens=16):
+    """用一段短提示词贪心生成 new_tokens 个 token，返回解码速度 (tokens/s)"""
+    input_ids = torch.tensor([tokenizer.encode("你好")], device=device)
+    with torch.no_grad():
+        start = time.perf_counter()
+        output = model.generate(
+            input_ids=input_ids,
+            attention_mask=torch.ones_like(input_ids),
+            max_new_tokens=new_tokens,
+            min_new_tokens=new_tokens,
+            do_sample=False,
+            pad_token_id=tokenizer.eos_token_id,
+        )
+        elapsed = time.perf_counter() - start
+    generated = output.shape[-1] - input_ids.shape[-1]
+    return generated / elapsed if elapsed > 0 else 0.0
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""
+辅助请求响应缓存
+翻译、情感等辅助请求使用固定的系统提示词，相同的输入直接返回缓存的回复；
+完全相同的并发请求合并为一次后端调用
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+
+
+def cache_key(backend, messages, **params):
+    """由后端标识、消息与生成参数计算缓存键；消息内容去掉首尾空白后参与计算"""
+    normalized = [
+        {"role": message.get("role"), "content": message.get("content", "").strip()
+         if isinstance(message.get("content"), str) else message.get("content")}
+        for message in messages
+    ]
+    payload = json.dumps({"backend": backend, "messages": normalized, "params": params},
+                         ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """带 TTL 的 LRU 响应缓存，可选地持久化到磁盘目录（每个键一个 JSON 文件）"""
+
+    def __init__(self, max_entries=512, ttl=86400, path=None):
+        self.max_entries = max(1, int(max_entries))
+        self.ttl = float(ttl) if ttl else None
+        self.path = path or None
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self._entries = OrderedDict()
+        self._inflight = {}
+        if self.path:
+            os.makedirs(self.path, exist_ok=True)
+
+    def _expired(self, created):
+        return self.ttl is not None and time.time() - created > self.ttl
+
+    def _file(self, key):
+        return os.path.join(self.path, f"{key}.json")
+
+    def get(self, key):
+        """返回缓存的回复，未命中或已过期时返回 None"""
+        entry = self._entries.get(key)
+        if entry is None and self.path:
+            entry = self._load(key)
+        if entry is None:
+            return None
+        created, value = entry
+        if self._expired(created):
+            self._entries.pop(key, None)
+            return None
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        self._evict()
+        return value
+
+    def put(self, key, value):
+        entry = (time.time(), value)
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        self._evict()
+        if self.path:
+            try:
+                with open(self._file(key), "w", encoding="utf-8") as f:
+                    json.dump({"created": entry[0], "value": value}, f, ensure_ascii=False)
+            except OSError as e:
+                print(f"⚠️ 写入响应缓存失败: {e}")
+
+    def _load(self, key):
+        try:
+            with open(self._file(key), "r", encoding="utf-8") as f:
+                data = json.load(f)
+            return data["created"], data["value"]
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def _evict(self):
+        # 只淘汰内存中的条目，磁盘上的文件按 TTL 失效
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def get_or_compute(self, key, compute, group=None):
+        """命中缓存时直接返回；同一个键已有请求在进行时等待其结果，否则调用 compute() 并缓存成功的结果
+
+        只有 group 相同的请求才会合并（例如按优先级分组，后台请求被丢弃时不会连累交互请求），
+        缓存的结果则在所有 group 之间共享。
+        """
+        value = self.get(key)
+        if value is not None:
+            self.hits += 1
+            print("♻️ 命中响应缓存")
+            return value
+        inflight_key = (key, group)
+        task = self._inflight.get(inflight_key)
+        if task is not None:
+            self.coalesced += 1
+            print("🔗 与进行中的相同请求合并")
+            return await asyncio.shield(task)
+
+        self.misses += 1
+        task = asyncio.ensure_future(compute())
+        self._inflight[inflight_key] = task
+
+        def on_done(done):
+            self._inflight.pop(inflight_key, None)
+            if not done.cancelled() and done.exception() is None:
+                self.put(key, done.result())
+
+        task.add_done_callback(on_done)
+        # shield：发起请求的客户端断开时，合并进来的其他请求仍能拿到结果
+        return await asyncio.shield(task)
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+        }
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+候选打分
+按给定提示词下的对数似然为一组候选续写打分，用于从固定标签中做分类而无需自回归生成
+"""
+
+import torch
+
+from .kv_cache import adapter_kwargs, from_legacy_cache, to_legacy_cache
+
+
+def score_continuations(model, prompt_ids, continuations, device, past=None, pad_token_id=0, adapter_name=None):
+    """返回每个候选续写的平均 token 对数似然
+
+    提示词只做一次前向计算（past 为其已缓存的前缀 KV）；所有候选随后右填充成一个批次，
+    共享提示词的 KV 缓存做一次前向计算。
+    """
+    prompt_length = len(prompt_ids)
+    start = past[0][0].shape[2] if past is not None else 0
+    with torch.no_grad():
+        outputs = model(
+            input_ids=torch.tensor([prompt_ids[start:]], device=device),
+            attention_mask=torch.ones((1, prompt_length), dtype=torch.long, device=device),
+            position_ids=torch.arange(start, prompt_length, device=device).unsqueeze(0),
+            past_key_values=from_legacy_cache(past),
+            use_cache=True,
+            logits_to_keep=1,
+            **adapter_kwargs(model, [adapter_name]),
+        )
+        first = torch.log_softmax(outputs.logits[0, -1].float(), dim=-1)
+
+        batch = len(continuations)
+        longest = max(len(tokens) for tokens in continuations)
+        rest = None
+        if longest > 1:
+            # 候选的最后一个 token 不需要作为输入，其概率来自倒数第二个位置的 logits
+            inputs = torch.full((batch, longest - 1), pad_token_id, dtype=torch.long, device=device)
+            mask = torch.zeros((batch, longest - 1), dtype=torch.long, device=device)
+            for row, tokens in enumerate(continuations):
+                inputs[row, :len(tokens) - 1] = torch.tensor(tokens[:-1], device=device)
+                mask[row, :len(tokens) - 1] = 1
+            prompt_past = tuple(
+                (key.expand(batch, -1, -1, -1), value.expand(batch, -1, -1, -1))
+                for key, value in to_legacy_cache(outputs.past_key_values)
+            )
+            outputs = model(
+                input_ids=inputs,
+                attention_mask=torch.cat(
+                    [torch.ones((batch, prompt_length), dtype=torch.long, device=device), mask], dim=-1),
+                position_ids=torch.arange(prompt_length, prompt_length + longest - 1, device=device).expand(batch, -1),
+                past_key_values=from_legacy_cache(prompt_past),
+                use_cache=True,
+                **adapter_kwargs(model, [adapter_name] * batch),
+            )
+            rest = torch.log_softmax(outputs.logits.float(), dim=-1)
+
+    scores = []
+    for row, tokens in enumerate(continuations):
+        total = float(first[tokens[0]])
+        for index, token in enumerate(tokens[1:]):
+            total += float(rest[row, index, token])
+        scores.append(total / len(tokens))
+    return scores
+
+
+def score_continuations_mlx(model, prompt_ids, continuations):
+    """MLX 版本：逐个候选做一次完整的前向计算"""
+    import mlx.core as mx
+
+    scores = []
+    for tokens in continuations:
+        logits = model(mx.array([list(prompt_ids) + list(tokens[:-1])]))[0, len(prompt_ids) - 1:]
+        logprobs = logits - mx.logsumexp(logits, axis=-1, keepdims=True)
+        total = sum(logprobs[index, token].item() for index, token in enumerate(tokens))
+        scores.append(total / len(tokens))
+    return scores
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""
+服务端会话
+由服务端保存对话历史与该会话的 KV 缓存，客户端每轮只需发送新消息
+"""
+
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+
+from .kv_cache import cache_nbytes
+
+
+class Session:
+    """一个对话会话：历史消息，以及上一轮结束时的 token 序列和 KV 缓存"""
+
+    def __init__(self, session_id, history):
+        self.id = session_id
+        self.history = list(history)
+        self.token_ids = None
+        self.past = None
+        self.created_at = time.time()
+        self.last_used = self.created_at
+        # 同一会话的多轮请求必须串行，否则历史和缓存会互相覆盖
+        self.lock = asyncio.Lock()
+        # 持有会话锁、正在进行的推理任务；交互请求到达时可以取消进行中的后台任务
+        self.running_job = None
+
+    @property
+    def cached(self):
+        if self.past is None:
+            return None
+        return self.token_ids, self.past
+
+    @property
+    def nbytes(self):
+        return cache_nbytes(self.past)
+
+    def info(self):
+        return {
+            "session_id": self.id,
+            "turns": len(self.history),
+            "cached_tokens": len(self.token_ids) if self.token_ids else 0,
+            "cache_bytes": self.nbytes,
+            "created_at": self.created_at,
+            "last_used": self.last_used,
+        }
+
+
+class SessionStore:
+    """按 LRU 管理会话
+
+    所有会话的 KV 缓存总量不超过 max_cache_bytes，超出时从最久未使用的会话开始丢弃缓存
+    （历史仍然保留，下一轮会重新 prefill）；会话数超过 max_sessions 时整个会话被移除。
+    """
+
+    def __init__(self, max_cache_bytes, max_sessions=64):
+        self.max_cache_bytes = int(max_cache_bytes)
+        self.max_sessions = max(1, int(max_sessions))
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def get(self, session_id):
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is not None:
+                self._sessions.move_to_end(session_id)
+                session.last_used = time.time()
+            return session
+
+    def get_or_create(self, session_id, history):
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                session = Session(session_id, history)
+                self._sessions[session_id] = session
+                while len(self._sessions) > self.max_sessions:
+                    self._sessions.popitem(last=False)
+            self._sessions.move_to_end(session_id)
+            session.last_used = time.time()
+            return session
+
+    def delete(self, session_id):
+        with self._lock:
+            return self._sessions.pop(session_id, None) is not None
+
+    def update_cache(self, session, token_ids, past):
+        """保存会话最新的 KV 缓存，并在超出内存预算时淘汰最久未使用的缓存"""
+        with self._lock:
+            if self._sessions.get(session.id) is not session:
+                return
+            session.token_ids = list(token_ids)
+            session.past = past
+            self._sessions.move_to_end(session.id)
+            total = sum(s.nbytes for s in self._sessions.values())
+            for victim in list(self._sessions.values()):
+                if total <= self.max_cache_bytes:
+                    break
+                if victim.past is None:
+                    continue
+                total -= victim.nbytes
+                victim.token_ids = None
+                victim.past = None
+                print(f"🧹 会话 {victim.id} 的 KV 缓存已被淘汰")
+
+    def stats(self):
+        with self._lock:
+            return {
+                "sessions": len(self._sessions),
+                "cache_bytes": sum(s.nbytes for s in self._sessions.values()),
+                "max_cache_bytes": self.max_cache_bytes,
+            }
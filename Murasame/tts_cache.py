@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+TTS 语音缓存
+按合成参数（文本、参考音频、采样参数、随机种子）的哈希保存 GPT-SoVITS 生成的 wav，
+命中时不再请求 TTS 服务；索引文件记录大小与最近使用时间，总大小超出上限时淘汰最久未用的语音。
+命中只更新内存中的最近使用时间，索引在写入新语音时或调用 flush() 时才落盘
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+
+INDEX_FILE = "index.json"
+
+
+def synthesis_key(params):
+    """合成参数的内容哈希；参考音频按路径与修改时间参与计算，替换参考音频后旧缓存自动失效"""
+    ref_audio = params.get("ref_audio_path", "")
+    stamp = os.path.getmtime(ref_audio) if ref_audio and os.path.exists(ref_audio) else None
+    payload = json.dumps({**params, "ref_audio_mtime": stamp}, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class TTSCache:
+    """目录中每条语音为 {key}.wav，index.json 为 {key: {"size", "last_used", "text"}}"""
+
+    def __init__(self, directory="./voices", max_bytes=512 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = int(max_bytes)
+        self._lock = threading.Lock()
+        # 内存中的最近使用时间是否比索引文件更新
+        self._dirty = False
+        os.makedirs(self.directory, exist_ok=True)
+        self._index = self._load_index()
+
+    def path(self, key):
+        return os.path.join(self.directory, f"{key}.wav")
+
+    def _load_index(self):
+        try:
+            with open(os.path.join(self.directory, INDEX_FILE), "r", encoding="utf-8") as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        # 去掉文件已被手动删除的条目
+        return {key: entry for key, entry in index.items() if os.path.exists(self.path(key))}
+
+    def _save_index(self):
+        index_path = os.path.join(self.directory, INDEX_FILE)
+        tmp_path = f"{index_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self._index, f, ensure_ascii=False)
+        os.replace(tmp_path, index_path)
+        self._dirty = False
+
+    def get(self, key):
+        """命中时返回 wav 数据并更新最近使用时间，否则返回 None"""
+        with self._lock:
+            entry = self._index.get(key)
+            if entry is None:
+                return None
+            if not os.path.exists(self.path(key)):
+                del self._index[key]
+                self._save_index()
+                return None
+            with open(self.path(key), "rb") as f:
+                data = f.read()
+            entry["last_used"] = time.time()
+            self._dirty = True
+            return data
+
+    def put(self, key, data, text=""):
+        """写入语音并返回路径；先写临时文件再原子替换，读取方不会看到写了一半的文件"""
+        path = self.path(key)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        with self._lock:
+            self._index[key] = {"size": len(data), "last_used": time.time(), "text": text[:50]}
+            self._evict(keep=key)
+            self._save_index()
+        return path
+
+    def _evict(self, keep):
+        total = sum(entry["size"] for entry in self._index.values())
+        for key in sorted(self._index, key=lambda k: self._index[k]["last_used"]):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            total -= self._index.pop(key)["size"]
+            try:
+                os.remove(self.path(key))
+            except OSError:
+                pass
+
+    def flush(self):
+        """把命中后更新的最近使用时间写入索引文件"""
+        with self._lock:
+            if self._dirty:
+                self._save_index()
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._index), "bytes": sum(entry["size"] for entry in self._index.values())}
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+上游 HTTP 客户端
+Ollama / OpenRouter 调用共用一个异步连接池：长连接、按路由的超时、有限次重试，以及可选的对冲请求
+"""
+
+import asyncio
+import random
+import time
+
+import httpx
+
+from .metrics import UPSTREAM_SECONDS
+from .worker import PRIORITY_BACKGROUND, PRIORITY_INTERACTIVE, QueueFullError
+
+# 这些状态码通常是暂时性的，可以重试
+RETRY_STATUS = {429, 500, 502, 503, 504}
+# 请求尚未到达上游时的错误可以重试；读取超时等错误发生时上游已在生成，重试只会成倍拉长最坏延迟
+RETRY_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+
+class UpstreamError(Exception):
+    """上游返回了错误状态或无法连接"""
+
+
+class UpstreamClient:
+    """共享的异步上游客户端
+
+    max_connections 限制并发连接数，同时等待中的请求超过 max_pending 时直接抛出 QueueFullError；
+    后台请求不排队，所有连接都被占用时直接丢弃，把等待的位置留给交互请求；
+    timeouts 为 {路由名: 读取超时秒数}，未列出的路由使用 default_timeout。
+    """
+
+    def __init__(self, max_connections=4, max_pending=16, timeouts=None, default_timeout=120.0,
+                 connect_timeout=5.0, retries=2, backoff=0.5):
+        self.max_connections = max(1, int(max_connections))
+        self.max_pending = max(1, int(max_pending))
+        self.timeouts = dict(timeouts or {})
+        self.default_timeout = float(default_timeout)
+        self.connect_timeout = float(connect_timeout)
+        self.retries = max(0, int(retries))
+        self.backoff = float(backoff)
+        self.pending = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self._client = None
+        self._slots = None
+
+    def start(self):
+        self._client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=self.max_connections,
+                max_keepalive_connections=self.max_connections,
+            ),
+        )
+        self._slots = asyncio.Semaphore(self.max_connections)
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def _timeout(self, route):
+        read = float(self.timeouts.get(route, self.default_timeout))
+        return httpx.Timeout(read, connect=self.connect_timeout)
+
+    async def post_json(self, route, url, payload, headers=None, priority=PRIORITY_INTERACTIVE):
+        """POST JSON 并返回解析后的响应；连接错误与暂时性状态码按指数退避重试，读取超时等其他错误不重试"""
+        if priority >= PRIORITY_BACKGROUND and self.pending >= self.max_connections:
+            raise QueueFullError("上游繁忙，丢弃后台请求")
+        if self.pending >= self.max_pending:
+            raise QueueFullError(f"上游请求队列已满 ({self.max_pending})")
+        self.pending += 1
+        try:
+            async with self._slots:
+                return await self._post_with_retries(route, url, payload, headers)
+        finally:
+            self.pending -= 1
+
+    async def _post_with_retries(self, route, url, payload, headers):
+        for attempt in range(self.retries + 1):
+            start = time.perf_counter()
+            try:
+                response = await self._client.post(
+                    url, json=payload, headers=headers, timeout=self._timeout(route))
+            except httpx.TransportError as e:
+                UPSTREAM_SECONDS.observe(time.perf_counter() - start, backend=route, outcome="error")
+                reason = f"{route} 请求失败: {e!r}"
+                if not isinstance(e, RETRY_ERRORS):
+                    raise UpstreamError(reason) from e
+            else:
+                ok = response.status_code < 400
+                UPSTREAM_SECONDS.observe(time.perf_counter() - start, backend=route, outcome="ok" if ok else "error")
+                if ok:
+                    return response.json()
+                reason = f"{route} 返回 {response.status_code}: {response.text[:500]}"
+                if response.status_code not in RETRY_STATUS:
+                    raise UpstreamError(reason)
+            if attempt == self.retries:
+                raise UpstreamError(reason)
+            delay = self.backoff * (2 ** attempt) * (0.5 + random.random())
+            print(f"🔁 {reason}，{delay:.1f} 秒后重试 ({attempt + 1}/{self.retries})")
+            await asyncio.sleep(delay)
+
+    async def hedge(self, primary, backup, delay):
+        """对冲请求：primary 在 delay 秒内没有返回时再发起 backup，先成功的结果胜出
+
+        primary / backup 为无参数、返回协程的函数；任一方失败时等待另一方，两方都失败时抛出 primary 的异常。
+        """
+        primary_task = asyncio.ensure_future(primary())
+        tasks = {primary_task}
+        errors = {}
+        # 调用方在任何一次等待中被取消时，finally 都会取消仍在进行的请求
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if done and primary_task.exception() is None:
+                return primary_task.result()
+
+            self.hedges += 1
+            print(f"⏱️ 主请求 {delay} 秒内未返回，发起对冲请求")
+            backup_task = asyncio.ensure_future(backup())
+            tasks.add(backup_task)
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is backup_task:
+                            self.hedge_wins += 1
+                            print("🏁 对冲请求先返回")
+                        return task.result()
+                    errors[task] = task.exception()
+            raise errors.get(primary_task) or errors[backup_task]
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def stats(self):
+        return {
+            "pending": self.pending,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+        }
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""
+视觉请求的图片预处理
+把客户端上传的截图缩放到视觉模型实际使用的分辨率并重新编码为 JPEG，
+并按感知哈希 (dHash) 缓存描述：与最近截图几乎相同的画面直接返回缓存的描述
+"""
+
+import base64
+import binascii
+import math
+import time
+from collections import OrderedDict
+from io import BytesIO
+
+from PIL import Image
+
+# Qwen2.5-VL 以 28x28 像素为一个视觉 token，宽高对齐到 28 的倍数
+PATCH_SIZE = 28
+
+
+def decode_image(value):
+    """把 base64 字符串或 data: URL 解码为 PIL 图片，无法解码时抛出 ValueError"""
+    if value.startswith("data:"):
+        value = value.partition(",")[2]
+    try:
+        image = Image.open(BytesIO(base64.b64decode(value, validate=False)))
+        image.load()
+    except (binascii.Error, OSError) as e:
+        raise ValueError(f"无法解码图片: {e}") from e
+    return image
+
+
+def fit_resolution(width, height, max_pixels):
+    """按比例缩小到不超过 max_pixels 个像素，宽高对齐到 PATCH_SIZE 的倍数"""
+    scale = min(1.0, math.sqrt(max_pixels / (width * height)))
+    fit_width = max(PATCH_SIZE, int(width * scale) // PATCH_SIZE * PATCH_SIZE)
+    fit_height = max(PATCH_SIZE, int(height * scale) // PATCH_SIZE * PATCH_SIZE)
+    return fit_width, fit_height
+
+
+def dhash(image, size=16):
+    """差值哈希：缩小为 (size+1)×size 的灰度图，比较相邻像素的明暗，得到 size*size 位的整数"""
+    pixels = list(image.convert("L").resize((size + 1, size), Image.Resampling.BILINEAR).getdata())
+    value = 0
+    for row in range(size):
+        for col in range(size):
+            left = pixels[row * (size + 1) + col]
+            right = pixels[row * (size + 1) + col + 1]
+            value = (value << 1) | (left > right)
+    return value
+
+
+def prepare_image(value, max_pixels=1280 * 28 * 28, quality=85):
+    """解码、缩放并重新编码图片，返回 (JPEG 的 base64 字符串, dHash, 原始尺寸, 处理后尺寸)"""
+    image = decode_image(value)
+    original_size = image.size
+    # dHash 在缩放前计算，与处理参数无关；桌面截图细节多，使用 16x16 (256 位) 的哈希
+    image_hash = dhash(image)
+    size = fit_resolution(*original_size, max_pixels)
+    if size != image.size:
+        image = image.resize(size, Image.Resampling.BICUBIC)
+    buffered = BytesIO()
+    image.convert("RGB").save(buffered, format="JPEG", quality=quality, optimize=True)
+    return base64.b64encode(buffered.getvalue()).decode(), image_hash, original_size, size
+
+
+class ImageDescriptionCache:
+    """按 (上下文键, dHash) 缓存视觉描述；汉明距离不超过 max_distance 的截图视为相同画面"""
+
+    def __init__(self, max_entries=64, max_distance=8, ttl=300):
+        self.max_entries = max(1, int(max_entries))
+        self.max_distance = int(max_distance)
+        self.ttl = float(ttl) if ttl else None
+        self.hits = 0
+        self.misses = 0
+        # (上下文键, dHash) -> (写入时间, 描述)
+        self._entries = OrderedDict()
+
+    def get(self, context_key, image_hash):
+        """返回距离最近且未过期的缓存描述与汉明距离，未命中时返回 (None, None)"""
+        now = time.time()
+        best, best_distance = None, None
+        for key, (created, response) in list(self._entries.items()):
+            if self.ttl is not None and now - created > self.ttl:
+                del self._entries[key]
+                continue
+            if key[0] != context_key:
+                continue
+            distance = bin(key[1] ^ image_hash).count("1")
+            if distance <= self.max_distance and (best_distance is None or distance < best_distance):
+                best, best_distance = key, distance
+        if best is None:
+            self.misses += 1
+            return None, None
+        self.hits += 1
+        self._entries.move_to_end(best)
+        return self._entries[best][1], best_distance
+
+    def put(self, context_key, image_hash, response):
+        self._entries[(context_key, image_hash)] = (time.time(), response)
+        self._entries.move_to_end((context_key, image_hash))
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def stats(self):
+        return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+"""
+推理工作器
+把阻塞的模型推理与上游 HTTP 调用移出事件循环，并通过有界队列做准入控制
+"""
+
+import asyncio
+import itertools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# 流结束标记
+_END = object()
+
+# 任务优先级：数值越小越先执行。用户发起的对话为交互任务，屏幕观察等自动触发的请求为后台任务
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 1
+PRIORITIES = {"interactive": PRIORITY_INTERACTIVE, "background": PRIORITY_BACKGROUND}
+
+
+def parse_priority(value):
+    """把请求中的 priority 字段转换为优先级，缺省或无法识别时按交互任务处理"""
+    if value is not None and value not in PRIORITIES:
+        print(f"⚠️ 未知的优先级: {value}，按 interactive 处理")
+    return PRIORITIES.get(value, PRIORITY_INTERACTIVE)
+
+
+class QueueFullError(Exception):
+    """队列已满，调用方应返回 429 让客户端稍后重试"""
+
+
+class QueueTimeoutError(Exception):
+    """任务在队列中等待过久，已被丢弃"""
+
+
+class JobCancelledError(Exception):
+    """任务被客户端取消（主动调用 /cancel 或断开连接）"""
+
+
+class Job:
+    """一次排队执行的任务
+
+    fn 在工作线程中以 fn(job, *args, **kwargs) 的形式调用，
+    流式任务可以在执行过程中调用 job.emit() 推送文本片段。
+    """
+
+    _ids = itertools.count(1)
+
+    def __init__(self, fn, args, kwargs, stream=False, priority=PRIORITY_INTERACTIVE, request_id=None):
+        self.id = next(Job._ids)
+        self.request_id = request_id
+        self.priority = priority
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.stream = stream
+        self.loop = asyncio.get_running_loop()
+        self.future = self.loop.create_future()
+        self.enqueued_at = time.perf_counter()
+        self.started_at = None
+        # 由任务函数填写的计时：first_token_at 为首个 token 的时间点，timings 中为 prefill / decode 秒数与 tokens 数
+        self.first_token_at = None
+        self.timings = {}
+        self.cancelled = threading.Event()
+        self._deltas = asyncio.Queue()
+
+    def emit(self, delta):
+        """推送一个流式片段（在工作线程中调用）"""
+        if self.stream:
+            self.loop.call_soon_threadsafe(self._deltas.put_nowait, delta)
+
+    def run(self):
+        return self.fn(self, *self.args, **self.kwargs)
+
+    def cancel(self):
+        """请求取消任务：排队中的任务不再执行，执行中的生成在下一个 token 边界停止"""
+        self.cancelled.set()
+
+    def check_cancelled(self):
+        """在工作线程中调用，任务已被取消时抛出 JobCancelledError"""
+        if self.cancelled.is_set():
+            raise JobCancelledError(f"任务 #{self.id} 已取消")
+
+    def finish(self, result=None, error=None):
+        """设置任务结果并结束流（在事件循环线程中调用）"""
+        if not self.future.done():
+            if error is not None:
+                self.future.set_exception(error)
+            else:
+                self.future.set_result(result)
+        self._deltas.put_nowait(_END)
+
+    async def iter_deltas(self):
+        """按顺序产出任务推送的片段，任务结束后停止"""
+        while True:
+            delta = await self._deltas.get()
+            if delta is _END:
+                return
+            yield delta
+
+    @property
+    def queue_wait(self):
+        if self.started_at is None:
+            return time.perf_counter() - self.enqueued_at
+        return self.started_at - self.enqueued_at
+
+
+class InferenceWorker:
+    """由 asyncio 优先级队列驱动的后台工作器
+
+    concurrency 个分发协程按优先级从队列取出任务，交给同样大小的线程池执行；
+    队列满时 submit 直接抛出 QueueFullError，排队超过 max_wait 秒的任务会被丢弃。
+    后台任务只在工作器空闲时被接受（不排队），并且最多占用 concurrency - reserved 个执行槽，
+    队列满时新的交互任务会挤掉排队中的后台任务。
+    """
+
+    def __init__(self, name, max_queue_depth=8, concurrency=1, max_wait=None, reserved=0):
+        self.name = name
+        self.max_queue_depth = max(1, int(max_queue_depth))
+        self.concurrency = max(1, int(concurrency))
+        self.background_slots = max(1, self.concurrency - max(0, int(reserved)))
+        self.max_wait = max_wait
+        self.running = 0
+        self.waiting = 0
+        self.dropped = 0
+        self._queue = None
+        self._queued_background = []
+        # 客户端提供的 request_id -> 对应的未完成任务，供 cancel() 查找
+        self._requests = {}
+        self._tasks = []
+        self._executor = None
+
+    def start(self):
+        """在事件循环中启动分发协程（应在应用启动时调用）"""
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.concurrency, thread_name_prefix=self.name)
+        self._queue = asyncio.PriorityQueue()
+        self._tasks = [asyncio.create_task(self._dispatch())
+                       for _ in range(self.concurrency)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+        self._executor.shutdown(wait=False)
+
+    @property
+    def depth(self):
+        return self.waiting
+
+    @property
+    def busy(self):
+        """有任务在排队，或后台任务可用的执行槽已被占满"""
+        return self.waiting > 0 or self.running >= self.background_slots
+
+    def submit(self, fn, *args, stream=False, priority=PRIORITY_INTERACTIVE, request_id=None, **kwargs):
+        """提交任务，返回 Job；队列已满（或后台任务遇到繁忙）时抛出 QueueFullError"""
+        if priority >= PRIORITY_BACKGROUND and self.busy:
+            self.dropped += 1
+            raise QueueFullError(f"{self.name} 繁忙，丢弃后台任务")
+        if self.waiting >= self.max_queue_depth and not (
+                priority < PRIORITY_BACKGROUND and self._drop_background()):
+            raise QueueFullError(
+                f"{self.name} 队列已满 ({self.max_queue_depth})")
+        job = Job(fn, args, kwargs, stream=stream, priority=priority, request_id=request_id)
+        if priority >= PRIORITY_BACKGROUND:
+            self._queued_background.append(job)
+        if request_id:
+            self._requests.setdefault(request_id, set()).add(job)
+            job.future.add_done_callback(lambda _: self._untrack(job))
+        self.waiting += 1
+        self._queue.put_nowait((priority, job.id, job))
+        return job
+
+    def _untrack(self, job):
+        jobs = self._requests.get(job.request_id)
+        if jobs is not None:
+            jobs.discard(job)
+            if not jobs:
+                del self._requests[job.request_id]
+
+    def cancel(self, request_id):
+        """取消 request_id 对应的全部任务，返回被取消的任务数；排队中的任务立即结束"""
+        jobs = list(self._requests.get(request_id, ()))
+        for job in jobs:
+            job.cancel()
+            if job.started_at is None and not job.future.done():
+                job.finish(error=JobCancelledError(f"任务 #{job.id} 已取消"))
+                self.waiting -= 1
+        return len(jobs)
+
+    def _drop_background(self):
+        # 丢弃最近排队的后台任务，为交互任务腾出队列位置
+        while self._queued_background:
+            job = self._queued_background.pop()
+            if not job.future.done():
+                print(f"⏬ {self.name} 队列已满，丢弃排队中的后台任务 #{job.id}")
+                job.finish(error=QueueFullError(f"{self.name} 繁忙，后台任务被交互请求挤出"))
+                self.waiting -= 1
+                self.dropped += 1
+                return True
+        return False
+
+    async def _dispatch(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            _, _, job = await self._queue.get()
+            try:
+                if job.future.done():
+                    # 已被交互任务挤出队列，或在排队时被取消
+                    continue
+                self.waiting -= 1
+                if job in self._queued_background:
+                    self._queued_background.remove(job)
+                if job.cancelled.is_set():
+                    job.finish(error=JobCancelledError(f"任务 #{job.id} 已取消"))
+                    continue
+                if self.max_wait is not None and job.queue_wait > self.max_wait:
+                    job.finish(error=QueueTimeoutError(
+                        f"{self.name} 排队超过 {self.max_wait} 秒"))
+                    continue
+                job.started_at = time.perf_counter()
+                self.running += 1
+                try:
+                    result = await loop.run_in_executor(self._executor, job.run)
+                except Exception as e:
+                    job.finish(error=e)
+                else:
+                    job.finish(result=result)
+                finally:
+                    self.running -= 1
+            finally:
+                self._queue.task_done()
@@ -5,17 +5,40 @@ MurasamePet API 服务
 """
 
 from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from contextlib import asynccontextmanager
 from datetime import datetime
+import asyncio
+import functools
 import uvicorn
-import requests
+import copy
 import json
 import torch
 import platform
 import sys
 import os
-from transformers import AutoModelForCausalLM, AutoTokenizer
+import time
+from transformers import (AutoModelForCausalLM, AutoTokenizer, LogitsProcessorList, StoppingCriteria,
+                          StoppingCriteriaList, TextStreamer)
 from peft import PeftModel
 from Murasame.utils import get_config
+from Murasame.worker import (PRIORITY_BACKGROUND, PRIORITY_INTERACTIVE, InferenceWorker, JobCancelledError, QueueFullError,
+                             QueueTimeoutError, parse_priority)
+from Murasame.batching import BatchScheduler, GenerationRequest, common_prefix_length
+from Murasame.kv_cache import PrefixCache, compute_prefix_cache, from_legacy_cache, to_legacy_cache
+from Murasame.sessions import SessionStore
+from Murasame.upstream import UpstreamClient, UpstreamError
+from Murasame.response_cache import ResponseCache, cache_key
+from Murasame.vision import ImageDescriptionCache, prepare_image
+from Murasame.metrics import (DECODE_RATE, GENERATED_TOKENS, REGISTRY, STAGE_SECONDS, Gauge, MetricsMiddleware)
+from Murasame.merged import is_merged_cache_valid, materialize_merged, merged_fingerprint
+from Murasame.quantize import (QUANTIZATION_MODES, benchmark_decode, is_quantized_cache_valid, load_quantized,
+                               model_nbytes, quantize_model, resolve_mode, save_quantized)
+from Murasame.history import compact_history, format_transcript, with_summary
+from Murasame.chat import identity, format_bot_response
+from Murasame.constraints import AllowedSequences, ConstrainedLogitsProcessor, mlx_logits_processor, resolve_options
+from Murasame.scoring import score_continuations, score_continuations_mlx
+from Murasame.prompts import TRANSLATE_PROMPT, emotion_prompt, layer_prompt, postprocess_prompt, postprocess_schema
 
 # 确保标准输出使用 UTF-8 编码，防止中文乱码
 if sys.stdout.encoding != 'utf-8':
@@ -31,7 +54,7 @@ if IS_MACOS:
     print("🍎 检测到 macOS 系统，初始化 MLX 引擎...")
     try:
         from mlx_lm.utils import load
-        from mlx_lm.generate import generate
+        from mlx_lm.generate import generate, stream_generate
         ENGINE = "mlx"
         DEVICE = "mlx"  # MLX 会自动使用 Apple Silicon GPU (Metal)
         print("✅ MLX 引擎加载成功 (Apple Silicon GPU 加速)")
@@ -60,13 +83,187 @@ else:
         DEVICE = "cpu"
         print("⚠️ PyTorch 引擎加载成功 (使用 CPU，性能可能较慢)")
 
-api = FastAPI()
+# 投机解码：小草稿模型（同为 Qwen3 分词器）一次提出多个 token，由主模型一次前向验证
+speculative_config = get_config().get('server', {}).get('speculative', {})
+USE_SPECULATIVE = ENGINE == "torch" and bool(speculative_config.get('enabled', False))
+draft_model = None
+
+# 启动预热：在接受请求前按代表性的提示词长度跑几次完整的生成，首个真实请求不再承担内核选择、显存分配与模板编译的开销
+warmup_config = get_config().get('server', {}).get('warmup', {})
+# 编译解码步：generate 使用静态 KV 缓存，解码步的形状固定后由 torch.compile 编译（仅 CUDA）
+COMPILE_DECODE = ENGINE == "torch" and bool(warmup_config.get('compile_decode', False))
+if COMPILE_DECODE and DEVICE != "cuda":
+    print(f"⚠️ 编译解码步仅支持 CUDA，当前设备为 {DEVICE}，已跳过")
+    COMPILE_DECODE = False
+if COMPILE_DECODE and USE_SPECULATIVE:
+    # 辅助生成不支持静态 KV 缓存
+    print("⚠️ 已启用投机解码，编译解码步将被关闭")
+    COMPILE_DECODE = False
+readiness = {"ready": False, "warmup_seconds": None}
+
+# 连续批处理配置：仅 PyTorch 引擎支持，多个 /chat 请求共享同一个解码批次
+batching_config = get_config().get('server', {}).get('batching', {})
+USE_BATCHING = ENGINE == "torch" and batching_config.get('enabled', True)
+if USE_BATCHING and USE_SPECULATIVE:
+    # 辅助生成只支持批大小 1，两者只能二选一
+    print("⚠️ 已启用投机解码，连续批处理将被关闭")
+    USE_BATCHING = False
+if USE_BATCHING and COMPILE_DECODE:
+    # 批处理调度器自行管理 KV 缓存，不经过 generate
+    print("⚠️ 已启用编译解码步，连续批处理将被关闭")
+    USE_BATCHING = False
+max_batch_size = int(batching_config.get('max_batch_size', 4)) if USE_BATCHING else 1
+scheduler = None
+
+# 前缀 KV 缓存：固定的系统提示词只 prefill 一次，之后的请求直接复用
+prefix_cache_config = get_config().get('server', {}).get('prefix_cache', {})
+prefix_cache = None
+if COMPILE_DECODE and prefix_cache_config.get('enabled', True):
+    # 静态 KV 缓存无法接上复用的前缀缓存
+    print("⚠️ 已启用编译解码步，前缀 KV 缓存将被关闭")
+elif ENGINE == "torch" and prefix_cache_config.get('enabled', True):
+    prefix_cache = PrefixCache(max_entries=prefix_cache_config.get('max_entries', 8))
+
+# 服务端会话：保存每个会话的历史与 KV 缓存，所有会话的缓存总量受内存预算限制
+session_config = get_config().get('server', {}).get('sessions', {})
+session_store = SessionStore(
+    max_cache_bytes=int(session_config.get('max_cache_mb', 2048)) * 1024 * 1024,
+    max_sessions=session_config.get('max_sessions', 64),
+)
+
+# 推理队列配置：本地模型推理由推理线程执行，上游 HTTP 调用走共享的异步连接池
+# 启用批处理时并发数为批大小加一个只给交互请求使用的保留槽，批次被后台请求占满时由调度器抢占
+queue_config = get_config().get('server', {}).get('queue', {})
+inference_worker = InferenceWorker(
+    "inference",
+    max_queue_depth=queue_config.get('max_depth', 8),
+    concurrency=max_batch_size + 1 if USE_BATCHING else max_batch_size,
+    max_wait=queue_config.get('max_wait_seconds'),
+    reserved=1 if USE_BATCHING else 0,
+)
+
+# 上游客户端：长连接复用、按路由的超时与重试；hedge 启用时 OpenRouter 超过延迟预算仍未返回则同时请求本地 Ollama
+upstream_config = get_config().get('server', {}).get('upstream', {})
+upstream_client = UpstreamClient(
+    max_connections=queue_config.get('upstream_concurrency', 4),
+    max_pending=queue_config.get('upstream_max_depth', 16),
+    timeouts=upstream_config.get('timeouts', {}),
+    connect_timeout=upstream_config.get('connect_timeout', 5),
+    retries=upstream_config.get('retries', 2),
+)
+hedge_config = upstream_config.get('hedge', {})
+
+# 辅助请求响应缓存：相同的 qwen3 辅助请求直接返回缓存的回复，并发的相同请求只调用一次后端
+response_cache_config = get_config().get('server', {}).get('response_cache', {})
+response_cache = None
+if response_cache_config.get('enabled', True):
+    response_cache = ResponseCache(
+        max_entries=response_cache_config.get('max_entries', 512),
+        ttl=response_cache_config.get('ttl_seconds', 86400),
+        path=response_cache_config.get('path') or None,
+    )
+
+# 视觉请求的图片预处理：截图缩放到视觉模型实际使用的分辨率并转为 JPEG，与最近截图几乎相同的画面直接返回缓存的描述
+vision_config = get_config().get('server', {}).get('vision', {})
+image_cache = None
+if vision_config.get('dedup', True):
+    image_cache = ImageDescriptionCache(
+        max_entries=vision_config.get('cache_entries', 64),
+        max_distance=vision_config.get('max_hash_distance', 8),
+        ttl=vision_config.get('cache_ttl_seconds', 300),
+    )
+
+
+@asynccontextmanager
+async def lifespan(app):
+    inference_worker.start()
+    upstream_client.start()
+    # 预热完成后 uvicorn 才开始接受请求，/health 也在此之后才报告就绪
+    if warmup_config.get('enabled', True):
+        try:
+            readiness["warmup_seconds"] = round(await warmup(), 2)
+            print(f"✅ 预热完成 (耗时 {readiness['warmup_seconds']} 秒)")
+        except Exception as e:
+            print(f"⚠️ 预热失败，直接开始服务: {e}")
+    readiness["ready"] = True
+    yield
+    await inference_worker.stop()
+    await upstream_client.close()
+
+
+api = FastAPI(lifespan=lifespan)
+api.add_middleware(MetricsMiddleware, exclude=("/metrics", "/health"))
+
+# 导出时读取的即时状态
+REGISTRY.register(Gauge("murasame_ready", "预热是否已完成", lambda: int(readiness["ready"])))
+REGISTRY.register(Gauge("murasame_queue_depth", "推理队列中等待的任务数", lambda: inference_worker.depth))
+REGISTRY.register(Gauge("murasame_running_jobs", "正在执行的推理任务数", lambda: inference_worker.running))
+REGISTRY.register(Gauge("murasame_background_dropped_total", "因繁忙被丢弃的后台任务数", lambda: inference_worker.dropped))
+REGISTRY.register(Gauge("murasame_batch_size", "连续批处理当前的批大小",
+                        lambda: scheduler.batch_size if scheduler is not None else 0))
+REGISTRY.register(Gauge("murasame_upstream_pending", "进行中与等待中的上游请求数", lambda: upstream_client.pending))
+REGISTRY.register(Gauge(
+    "murasame_response_cache_events", "响应缓存的命中、未命中与合并次数",
+    lambda: {(event,): count for event, count in response_cache.stats().items() if event != "entries"}
+    if response_cache is not None else {}, ("event",)))
+REGISTRY.register(Gauge(
+    "murasame_image_cache_events", "视觉描述缓存的命中与未命中次数",
+    lambda: {(event,): count for event, count in image_cache.stats().items() if event != "entries"}
+    if image_cache is not None else {}, ("event",)))
 
 adapter_path = "./models/Murasame"
 max_seq_length = 2048
 
+# 历史压缩：提示词超出 token 预算时保留系统提示词和最近的轮次，可选把被移出的轮次折叠成滚动摘要
+# 预算需要给回复留出 reply_tokens 个位置，配置的 max_prompt_tokens 不能超过 max_seq_length - reply_tokens
+history_config = get_config().get('server', {}).get('history', {})
+reply_tokens = int(history_config.get('reply_tokens', 512))
+prompt_limit = max(1, max_seq_length - reply_tokens)
+history_budget = int(history_config.get('max_prompt_tokens', prompt_limit))
+if history_budget > prompt_limit:
+    print(f"⚠️ max_prompt_tokens ({history_budget}) 超出上下文长度 {max_seq_length} 减去回复预留的 {reply_tokens}，"
+          f"已调整为 {prompt_limit}")
+    history_budget = prompt_limit
+summarize_history = bool(history_config.get('summarize', False))
+summary_tokens = int(history_config.get('summary_tokens', 256))
+
+# 受限解码：带 constraint 的 /qwen3 请求由本地模型配合 logits processor ("local")，或由 qwen3 后端的结构化输出 ("upstream") 完成
+constrained_backend = get_config().get('server', {}).get('constrained_decoding', 'upstream')
+
+# 进程内辅助模型：/qwen3 等辅助请求直接在已加载的基础模型上执行（按请求禁用 LoRA），不再需要单独的 Qwen3 后端
+# 仅 PyTorch 引擎支持；MLX 加载的是已合并 LoRA 的模型，无法按请求关闭适配器
+BASE_ADAPTER = "__base__"
+helper_in_process = ENGINE == "torch" and bool(get_config().get('server', {}).get('helper_in_process', False))
+if IS_MACOS and get_config().get('server', {}).get('helper_in_process', False):
+    print("⚠️ MLX 引擎不支持进程内辅助模型，/qwen3 仍使用配置的后端")
+
+# 合并权重缓存：首次启动（或 --materialize）时把 LoRA 合并进基础模型并保存，之后直接加载合并后的模型
+merged_config = get_config().get('server', {}).get('merged_weights', {})
+merged_path = merged_config.get('path', './models/Murasame-merged')
+use_merged_weights = ENGINE == "torch" and bool(merged_config.get('enabled', False))
+if use_merged_weights and helper_in_process:
+    # 合并后的模型无法再按请求禁用 LoRA
+    print("⚠️ 进程内辅助模型需要保留 LoRA 适配器，已跳过合并权重缓存")
+    use_merged_weights = False
+
+# CPU 量化推理：把合并后的模型线性层量化为 int8 / int4 权重，量化结果缓存到磁盘
+quantization_config = get_config().get('server', {}).get('cpu_quantization', {})
+quantization_mode = quantization_config.get('mode', 'none')
+if quantization_mode not in QUANTIZATION_MODES:
+    quantization_mode = None
+elif DEVICE != "cpu":
+    print(f"⚠️ {quantization_mode} 量化仅用于 CPU 推理，当前设备为 {DEVICE}，已跳过")
+    quantization_mode = None
+elif helper_in_process:
+    print("⚠️ 进程内辅助模型需要保留 LoRA 适配器，已跳过 CPU 量化")
+    quantization_mode = None
+else:
+    # 按实际可用的模式确定缓存路径，int4 回退到 int8 时启动检查的也是 int8 缓存
+    quantization_mode = resolve_mode(quantization_mode)
+quantized_path = quantization_config.get('path', './models/Murasame-{mode}').format(mode=quantization_mode)
 
-def load_model_and_tokenizer():
+
+def load_model_and_tokenizer(materialize=False):
     print(f"📂 模型加载路径: {adapter_path}")
     print(f"⚙️ 推理引擎: {ENGINE} | 计算设备: {DEVICE}")
 
@@ -144,13 +341,27 @@ def load_model_and_tokenizer():
             if not base_model_path:
                 print("❌ 严重错误：适配器配置缺少 base_model_name_or_path")
                 exit(1)
+
+            torch_dtype = torch.float16 if DEVICE == "cuda" else torch.float32
+            device_map = "auto" if DEVICE == "cuda" else "cpu"
+            fingerprint = merged_fingerprint(adapter_path, base_model_path)
+            if quantization_mode and not materialize and is_quantized_cache_valid(quantized_path, fingerprint, quantization_mode):
+                print(f"⚡ 正在加载 {quantization_mode} 量化模型缓存: {quantized_path}")
+                model = load_quantized(quantized_path)
+                tokenizer = load_tokenizer(quantized_path)
+                report_quantized(model, tokenizer, benchmark=False)
+                return model, tokenizer
+            if use_merged_weights and not materialize and is_merged_cache_valid(merged_path, fingerprint):
+                model, tokenizer = load_merged_model(torch_dtype, device_map)
+                if quantization_mode:
+                    model = quantize_and_cache(model, tokenizer, fingerprint)
+                return model, tokenizer
+
             if not os.path.exists(base_model_path):
                 print(f"❌ 严重错误：基础模型路径不存在: {base_model_path}")
                 print("💡 请确认 Qwen3-14B 模型是否已下载并与 adapter_config.json 中的路径一致")
                 exit(1)
 
-            torch_dtype = torch.float16 if DEVICE == "cuda" else torch.float32
-            device_map = "auto" if DEVICE == "cuda" else "cpu"
             if DEVICE == "cpu":
                 print("⚠️  警告: 在 CPU 上加载 14B 模型需要大量内存 (通常 > 32GB)，请确保可用内存充足。")
 
@@ -174,13 +385,18 @@ def load_model_and_tokenizer():
 
             model.eval()
 
-            tokenizer = AutoTokenizer.from_pretrained(
-                base_model_path,
-                trust_remote_code=True,
-            )
-            if tokenizer.pad_token is None:
-                tokenizer.pad_token = tokenizer.eos_token
-            tokenizer.padding_side = "left"
+            tokenizer = load_tokenizer(base_model_path)
+
+            if use_merged_weights or materialize:
+                print(f"🧬 正在合并 LoRA 并写入合并权重缓存: {merged_path}")
+                model = materialize_merged(
+                    model, tokenizer, merged_path, fingerprint,
+                    max_shard_size=merged_config.get('max_shard_size', '2GB'))
+                model.eval()
+                print("✅ 合并权重缓存已保存，之后启动将直接加载合并后的模型")
+
+            if quantization_mode and not materialize:
+                model = quantize_and_cache(model, tokenizer, fingerprint)
 
             print("✅ LoRA 模型加载成功！")
             print(f"   📍 基础模型: {base_model_path}")
@@ -203,19 +419,90 @@ def load_model_and_tokenizer():
     return model, tokenizer
 
 
+def load_tokenizer(path):
+    tokenizer = AutoTokenizer.from_pretrained(
+        path,
+        trust_remote_code=True,
+    )
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    tokenizer.padding_side = "left"
+    return tokenizer
+
+
+def load_merged_model(torch_dtype, device_map):
+    """从合并权重缓存加载模型：safetensors 以内存映射方式读取，不再经过 PEFT 包装"""
+    print(f"⚡ 正在加载合并权重缓存: {merged_path}")
+    model = AutoModelForCausalLM.from_pretrained(
+        merged_path,
+        torch_dtype=torch_dtype,
+        device_map=device_map,
+        low_cpu_mem_usage=True,
+    )
+    if DEVICE in ("cpu", "cuda"):
+        model = model.to(DEVICE)
+    model.eval()
+    tokenizer = load_tokenizer(merged_path)
+    print("✅ 合并模型加载成功！")
+    print(f"   📍 合并权重: {merged_path}")
+    print(f"   🏷️ 推理设备: {DEVICE}")
+    return model, tokenizer
+
+
+def quantize_and_cache(model, tokenizer, fingerprint):
+    """合并 LoRA（如尚未合并）后量化模型，写入量化缓存并报告内存与速度"""
+    if isinstance(model, PeftModel):
+        model = model.merge_and_unload()
+    size_before = model_nbytes(model)
+    speed_before = benchmark_decode(model, tokenizer, DEVICE) if quantization_config.get('benchmark', True) else None
+    print(f"🗜️ 正在进行 {quantization_mode} 量化...")
+    model, mode = quantize_model(model, quantization_mode)
+    model.eval()
+    save_quantized(model, tokenizer, quantized_path, fingerprint, mode)
+    print(f"✅ 量化模型已缓存: {quantized_path}")
+    report_quantized(model, tokenizer, size_before, speed_before,
+                     benchmark=quantization_config.get('benchmark', True))
+    return model
+
+
+def report_quantized(model, tokenizer, size_before=None, speed_before=None, benchmark=False):
+    """打印量化模型的权重内存；benchmark 为真时同时测量解码速度（只在刚完成量化时进行）"""
+    size = model_nbytes(model) / 1024 ** 3
+    line = f"📊 量化模型权重: {size:.2f} GB"
+    if size_before:
+        line += f" (量化前 {size_before / 1024 ** 3:.2f} GB)"
+    if benchmark:
+        speed = benchmark_decode(model, tokenizer, DEVICE)
+        line += f" | 解码速度: {speed:.2f} tokens/s"
+        if speed_before:
+            line += f" (量化前 {speed_before:.2f} tokens/s)"
+    print(line)
+
+
 # 辅助函数：获取当前时间
 def get_current_time():
     return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
 
+# 日志中提示词与回复的最大字符数，超出部分截断；0 表示不截断
+log_max_chars = int(get_config().get('server', {}).get('log_max_chars', 200))
+
+
+def truncate_for_log(text):
+    text = str(text)
+    if log_max_chars <= 0 or len(text) <= log_max_chars:
+        return text
+    return f"{text[:log_max_chars]}… (共 {len(text)} 字符)"
+
+
 # 辅助函数：记录请求日志
 def log_request(prompt):
-    print(f'📥 [{get_current_time()}] 收到用户请求: {prompt}')
+    print(f'📥 [{get_current_time()}] 收到用户请求: {truncate_for_log(prompt)}')
 
 
 # 辅助函数：记录响应日志
 def log_response(response):
-    print(f'📤 [{get_current_time()}] 生成最终回复: {response}')
+    print(f'📤 [{get_current_time()}] 生成最终回复: {truncate_for_log(response)}')
 
 
 # 辅助函数：解析请求
@@ -236,10 +523,29 @@ def create_response(response_text, history, status=200):
     }
 
 
+# 辅助函数：队列繁忙时返回 429，提示客户端稍后重试
+def busy_response(error, history):
+    error_msg = f"服务繁忙: {str(error)}，请稍后重试"
+    print(f"🚦 {error_msg}")
+    return JSONResponse(
+        status_code=429,
+        content=create_response(error_msg, history, status=429),
+        headers={"Retry-After": "1"},
+    )
+
+
+def cancelled_response(error, history):
+    # 499: 客户端已取消请求（沿用 nginx 的约定）
+    error_msg = f"请求已取消: {str(error)}"
+    print(f"🛑 {error_msg}")
+    return JSONResponse(status_code=499, content=create_response(error_msg, history, status=499))
+
+
 # MLX 不需要手动垃圾回收
 
 
-def call_openrouter_api(config, api_key, model, messages, image_url=None, max_tokens=2048):
+async def call_openrouter_api(config, api_key, model, messages, image_url=None, max_tokens=2048, schema=None,
+                              priority=PRIORITY_INTERACTIVE):
     """调用 OpenRouter API"""
     headers = {
         "Authorization": f"Bearer {api_key}",
@@ -250,6 +556,8 @@ def call_openrouter_api(config, api_key, model, messages, image_url=None, max_to
 
     # 处理图像输入 - 按照 OpenRouter 官方文档格式
     if image_url:
+        # 对冲请求可能同时把原始消息发给 Ollama，这里修改副本
+        messages = copy.deepcopy(messages)
         # 如果有图像，将最后一个用户消息修改为包含图像
         for message in reversed(messages):
             if message['role'] == 'user':
@@ -270,206 +578,1157 @@ def call_openrouter_api(config, api_key, model, messages, image_url=None, max_to
         "temperature": 0.7,
         "max_tokens": max_tokens
     }
+    if schema is not None:
+        # 结构化输出：要求模型按 JSON Schema 返回
+        data["response_format"] = {
+            "type": "json_schema",
+            "json_schema": {"name": "result", "strict": True, "schema": schema}
+        }
 
     # 从配置中获取 OpenRouter 地址，如果不存在则使用默认值
     endpoint_url = config.get('endpoints', {}).get('openrouter', "https://openrouter.ai/api/v1/chat/completions")
-    response = requests.post(endpoint_url, headers=headers, json=data)
-    response.raise_for_status()
-    return response.json()
+    return await upstream_client.post_json("openrouter", endpoint_url, data, headers=headers, priority=priority)
 
 
-@api.post("/chat")
-async def create_chat(request: Request):
-    json_post_list = await request.json()
-    prompt, history = parse_request(json_post_list)
-    log_request(prompt)
-    history = history + [{'role': 'user', 'content': prompt}]
+async def call_ollama_api(endpoint_url, model, messages, schema=None, priority=PRIORITY_INTERACTIVE):
+    """调用 Ollama /api/chat，返回回复文本"""
+    payload = {"model": model, "messages": messages,
+               "stream": False, "options": {"keep_alive": -1}}
+    if schema is not None:
+        payload["format"] = schema
+    result = await upstream_client.post_json("ollama", f"{endpoint_url}/api/chat", payload, priority=priority)
+    return result['message']['content']
 
-    # 使用 MLX 进行推理
-    print(f"💬 使用 {ENGINE.upper()} 引擎进行推理...")
-    print(f"📊 最大生成长度: {json_post_list.get('max_new_tokens', 2048)} tokens")
-    
-    text = tokenizer.apply_chat_template(
-        history,
-        tokenize=False,
-        add_generation_prompt=True,
-        enable_thinking=False,
+
+async def call_with_hedge(openrouter_call, ollama_model, messages, schema=None, priority=PRIORITY_INTERACTIVE):
+    """调用 OpenRouter；启用对冲时超过延迟预算仍未返回则同时请求本地 Ollama，先返回者胜出"""
+    async def primary():
+        result = await openrouter_call()
+        return result['choices'][0]['message']['content']
+
+    hedge_url = hedge_config.get('ollama', '') if hedge_config.get('enabled', False) else ''
+    if not hedge_url:
+        return await primary()
+    return await upstream_client.hedge(
+        primary,
+        lambda: call_ollama_api(hedge_url, ollama_model, messages, schema=schema, priority=priority),
+        float(hedge_config.get('delay_seconds', 3.0)),
     )
-    print("✅ 聊天模板应用完成")
 
+
+# 辅助函数：解析生成参数
+def parse_generation_params(json_post_list):
     max_new_tokens = int(json_post_list.get('max_new_tokens', 2048))
     max_new_tokens = max(1, max_new_tokens)
     temperature = float(json_post_list.get('temperature', 0.7))
     top_p = float(json_post_list.get('top_p', 0.9))
     top_p = max(0.01, min(top_p, 1.0))
+    return max_new_tokens, temperature, top_p
+
+
+# 辅助函数：将数据编码为一条 SSE 事件
+def sse_event(data, event=None):
+    payload = json.dumps(data, ensure_ascii=False)
+    if event:
+        return f"event: {event}\ndata: {payload}\n\n"
+    return f"data: {payload}\n\n"
+
+
+class JobStreamer(TextStreamer):
+    """把 model.generate 解码出的文本片段推送给排队任务"""
+
+    def __init__(self, tokenizer, job):
+        super().__init__(tokenizer, skip_prompt=True, skip_special_tokens=True)
+        self.job = job
+        # 主模型的解码步数：投机解码时每一步可能一次输出多个 token
+        self.steps = 0
+
+    def put(self, value):
+        if not (self.skip_prompt and self.next_tokens_are_prompt):
+            self.steps += 1
+            if self.job.first_token_at is None:
+                self.job.first_token_at = time.perf_counter()
+        super().put(value)
+
+    def on_finalized_text(self, text, stream_end=False):
+        if text:
+            self.job.emit(text)
+
+
+class JobCancelledCriteria(StoppingCriteria):
+    """任务被取消后在下一个 token 处停止 model.generate"""
+
+    def __init__(self, job):
+        self.job = job
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return torch.full((input_ids.shape[0],), self.job.cancelled.is_set(), dtype=torch.bool, device=input_ids.device)
+
+
+def system_prefix_length(history, input_ids):
+    """返回以系统提示词结尾的静态前缀 token 数；没有系统提示词时返回 0"""
+    if not history or history[0].get('role') != 'system':
+        return 0
+    prefix_text = tokenizer.apply_chat_template(
+        history[:1],
+        tokenize=False,
+        add_generation_prompt=False,
+    )
+    prefix_ids = tokenizer(prefix_text)["input_ids"]
+    if input_ids[:len(prefix_ids)] != prefix_ids:
+        return 0
+    return len(prefix_ids)
+
+
+def warm_prefix_cache(history):
+    """预先计算系统提示词的 KV 缓存"""
+    prefix_text = tokenizer.apply_chat_template(
+        history[:1],
+        tokenize=False,
+        add_generation_prompt=False,
+    )
+    prefix_ids = tokenizer(prefix_text)["input_ids"]
+    prefix_cache.store(prefix_ids, compute_prefix_cache(model, prefix_ids, DEVICE))
+    return len(prefix_ids)
+
+
+def warmup_history(prompt_tokens):
+    """构造用户消息约为 prompt_tokens 个 token 的对话，系统提示词使用丛雨人设"""
+    sentence = "主人，今天也要一起去神社散步吗？本座想吃芭菲和布丁。"
+    ids = tokenizer.encode(sentence * (prompt_tokens // 8 + 1), add_special_tokens=False)[:prompt_tokens]
+    return identity() + [{"role": "user", "content": tokenizer.decode(ids)}]
+
+
+async def warmup():
+    """按配置的提示词长度依次执行完整的生成，启用批处理时再同时提交一批请求，返回总耗时（秒）"""
+    lengths = [int(length) for length in warmup_config.get('prompt_tokens', [64, 512])]
+    decode_tokens = max(1, int(warmup_config.get('decode_tokens', 16)))
+    print(f"🔥 正在预热 (提示词长度: {lengths}，每次解码 {decode_tokens} tokens)...")
+    start = time.perf_counter()
+
+    def submit(length):
+        history = warmup_history(length)
+        text = tokenizer.apply_chat_template(
+            history,
+            tokenize=False,
+            add_generation_prompt=True,
+            enable_thinking=False,
+        )
+        return inference_worker.submit(run_chat_job, text, history, decode_tokens, 0.7, 0.9).future
 
-    # 推理
+    for length in lengths:
+        step_start = time.perf_counter()
+        await submit(length)
+        print(f"   🔥 {length} tokens 提示词: {time.perf_counter() - step_start:.2f} 秒")
+    if scheduler is not None and lengths:
+        # 同时解码多行，预热批处理的形状
+        step_start = time.perf_counter()
+        await asyncio.gather(*(submit(lengths[0]) for _ in range(max_batch_size)))
+        print(f"   🔥 {max_batch_size} 个并发请求: {time.perf_counter() - step_start:.2f} 秒")
+    return time.perf_counter() - start
+
+
+def enable_compiled_decode():
+    """为 generate 的解码步启用 torch.compile，首次编译在预热阶段完成；返回是否启用成功"""
+    try:
+        from transformers import CompileConfig
+    except ImportError:
+        print("⚠️ 当前 transformers 版本不支持 CompileConfig，编译解码步未启用")
+        return False
+    # PeftModel.generate 使用基础模型的 generation_config
+    base = model.get_base_model() if hasattr(model, "get_base_model") else model
+    base.generation_config.compile_config = CompileConfig(mode=warmup_config.get('compile_mode', 'reduce-overhead'))
+    return True
+
+
+def summary_messages(previous_summary, evicted):
+    """构造把被移出的对话折叠进滚动摘要的请求"""
+    content = ""
+    if previous_summary:
+        content += f"已有摘要：\n{previous_summary}\n\n"
+    content += f"新增对话：\n{format_transcript(evicted)}"
+    messages = [
+        {"role": "system", "content": f"你是对话摘要助手。请把已有摘要和新增对话合并为一段简洁的中文摘要，保留人物关系、重要事实、约定和未完成的话题，不超过 {summary_tokens} 字，只输出摘要本身。"},
+        {"role": "user", "content": content},
+    ]
+    return messages
+
+
+def render_prompt(history):
+    """应用聊天模板，返回 (提示词文本, token 数)"""
+    text = tokenizer.apply_chat_template(
+        history,
+        tokenize=False,
+        add_generation_prompt=True,
+        enable_thinking=False,
+    )
+    return text, len(tokenizer.encode(text))
+
+
+async def compact_for_prompt(history, priority=PRIORITY_INTERACTIVE):
+    """历史超出 token 预算时进行压缩；开启摘要时由 qwen3 后端生成新的滚动摘要，失败则直接丢弃被移出的轮次
+
+    返回 (压缩后的历史, 提示词文本, 提示词 token 数)；模板渲染与分词在线程中执行，不阻塞事件循环，未压缩时直接复用渲染结果。
+    """
+    text, prompt_tokens = await asyncio.to_thread(render_prompt, history)
+    if prompt_tokens <= history_budget:
+        return history, text, prompt_tokens
+    reserve = summary_tokens if summarize_history else 0
+    compacted, evicted, previous_summary = await asyncio.to_thread(
+        compact_history, history, tokenizer, history_budget, reserve=reserve, prompt_tokens=prompt_tokens)
+    print(f"✂️ 历史超出 {history_budget} tokens，移出最早的 {len(evicted)} 条消息")
+    if summarize_history and evicted:
+        try:
+            summary = await complete_qwen3(
+                get_config(), summary_messages(previous_summary, evicted), priority=priority)
+            summary = summary.split("</think>")[-1].strip()
+            print(f"📝 已更新历史摘要 (长度: {len(summary)} 字符)")
+            compacted = with_summary(compacted, summary)
+        except Exception as e:
+            print(f"⚠️ 生成历史摘要失败，直接丢弃被移出的消息: {e}")
+    text, prompt_tokens = await asyncio.to_thread(render_prompt, compacted)
+    return compacted, text, prompt_tokens
+
+
+def clamp_new_tokens(max_new_tokens, prompt_tokens):
+    """限制生成长度，使提示词加回复不超过 max_seq_length"""
+    return max(1, min(max_new_tokens, max_seq_length - prompt_tokens))
+
+
+def model_call(fn, *args, **kwargs):
+    """执行直接使用模型的前向计算
+
+    调度器运行时只能由调度器线程使用模型（与进行中的解码步、以及按行切换的辅助适配器互斥），
+    因此交给调度器在两个解码步之间执行；生成请求本身则作为批次中的一行交给调度器。
+    """
+    if scheduler is not None:
+        return scheduler.call(fn, *args, **kwargs)
+    return fn(*args, **kwargs)
+
+
+def cached_system_prefix(input_ids, prefix_length, adapter_name=None):
+    """返回系统提示词前缀的 KV 缓存，未命中时计算并写入前缀缓存；prefix_length 为 0 时返回 None"""
+    if not prefix_length:
+        return None
+    cached_length, past = prefix_cache.lookup(input_ids, namespace=adapter_name)
+    if cached_length < prefix_length:
+        past = model_call(
+            compute_prefix_cache, model, input_ids[:prefix_length], DEVICE, adapter_name=adapter_name)
+        prefix_cache.store(input_ids[:prefix_length], past, namespace=adapter_name)
+    else:
+        print(f"♻️ 命中前缀缓存，复用 {cached_length} 个 token")
+    return past
+
+
+def run_chat_job(job, text, history, max_new_tokens, temperature, top_p, session=None, constraint=None,
+                 adapter_name=None):
+    """在推理线程中生成回复，边解码边通过 job.emit 推送片段
+
+    传入 session 时会复用该会话上一轮的 KV 缓存，并在生成结束后写回最新的缓存；
+    传入 constraint (AllowedSequences) 时只允许生成其中的选项，并使用贪心解码；
+    adapter_name 为 BASE_ADAPTER 时本次生成禁用 LoRA，使用基础模型。
+    """
     print("🤖 正在生成回复...")
     if ENGINE == "mlx":
-        response = generate(
+        pieces = []
+        mlx_kwargs = {}
+        if constraint is not None:
+            mlx_kwargs["logits_processors"] = [mlx_logits_processor(constraint)]
+        start, tokens = time.perf_counter(), 0
+        for chunk in stream_generate(
             model, tokenizer,
             prompt=text,
             max_tokens=max_new_tokens,
-            verbose=False
+            **mlx_kwargs,
+        ):
+            job.check_cancelled()
+            tokens += 1
+            if job.first_token_at is None:
+                job.first_token_at = time.perf_counter()
+            piece = getattr(chunk, "text", chunk)
+            if piece:
+                pieces.append(piece)
+                job.emit(piece)
+        record_generation(job, start, tokens)
+        return "".join(pieces).strip()
+
+    input_ids = tokenizer(text)["input_ids"]
+    prefix_length = system_prefix_length(history, input_ids) if prefix_cache is not None else 0
+
+    if scheduler is not None:
+        # 交给连续批处理调度器，与其他进行中的请求合并解码
+        request = GenerationRequest(
+            input_ids,
+            max_new_tokens,
+            temperature=temperature if constraint is None else 0.0,
+            top_p=top_p,
+            on_text=job.emit,
+            prefix_length=prefix_length,
+            cached=session.cached if session is not None else None,
+            on_cache=(lambda ids, past: session_store.update_cache(session, ids, past))
+            if session is not None else None,
+            constraint=constraint,
+            adapter_name=adapter_name,
+            priority=job.priority,
+            cancelled=job.cancelled,
         )
-        reply = response.strip()
-    else:
-        encoded = tokenizer(
-            text,
-            return_tensors="pt",
+        reply = scheduler.generate(request)
+        job.first_token_at = request.first_token_at
+        job.timings.update(
+            prefill=request.prefill_seconds,
+            decode=request.finished_at - request.first_token_at,
+            tokens=len(request.generated),
         )
-        encoded = {k: v.to(DEVICE) for k, v in encoded.items()}
-        generation_kwargs = {
-            "max_new_tokens": max_new_tokens,
-            "do_sample": True,
-            "temperature": max(0.01, temperature),
-            "top_p": top_p,
-            "eos_token_id": tokenizer.eos_token_id,
-            "pad_token_id": tokenizer.eos_token_id,
-        }
-        with torch.no_grad():
-            generated = model.generate(
-                **encoded,
-                **generation_kwargs,
-            )
-        generated_tokens = generated[0, encoded["input_ids"].shape[-1]:]
-        reply = tokenizer.decode(generated_tokens, skip_special_tokens=True).strip()
+        return reply
+
+    past = cached_system_prefix(input_ids, prefix_length, adapter_name)
+    reused = prefix_length
+    if session is not None and session.cached is not None:
+        cached_ids, cached_past = session.cached
+        reuse = min(common_prefix_length(cached_ids, input_ids), len(input_ids) - 1)
+        if reuse > reused:
+            print(f"♻️ 复用会话缓存 {reuse} 个 token")
+            past = tuple((key[:, :, :reuse], value[:, :, :reuse]) for key, value in cached_past)
+
+    encoded = {
+        "input_ids": torch.tensor([input_ids], device=DEVICE),
+        "attention_mask": torch.ones((1, len(input_ids)), dtype=torch.long, device=DEVICE),
+    }
+    streamer = JobStreamer(tokenizer, job)
+    generation_kwargs = {
+        "max_new_tokens": max_new_tokens,
+        "do_sample": True,
+        "temperature": max(0.01, temperature),
+        "top_p": top_p,
+        "eos_token_id": tokenizer.eos_token_id,
+        "pad_token_id": tokenizer.eos_token_id,
+        "streamer": streamer,
+        "stopping_criteria": StoppingCriteriaList([JobCancelledCriteria(job)]),
+    }
+    speculative = draft_model is not None and constraint is None and adapter_name is None
+    if speculative:
+        generation_kwargs["assistant_model"] = draft_model
+    if constraint is not None:
+        # 自定义 logits processor 位于 temperature/top_p 之后，受限解码改用贪心解码，避免合法 token 全被 top_p 过滤
+        generation_kwargs.update(do_sample=False, temperature=None, top_p=None)
+        generation_kwargs["logits_processor"] = LogitsProcessorList([ConstrainedLogitsProcessor(constraint)])
+    if adapter_name is not None:
+        generation_kwargs["adapter_names"] = [adapter_name]
+    if past is not None:
+        generation_kwargs["past_key_values"] = from_legacy_cache(past)
+    elif COMPILE_DECODE and session is None and not speculative:
+        # 静态 KV 缓存的形状固定，generate 会用编译后的前向执行解码步；会话需要写回动态缓存，仍走未编译的路径
+        generation_kwargs["cache_implementation"] = "static"
+    if session is not None:
+        generation_kwargs["return_dict_in_generate"] = True
+    start = time.perf_counter()
+    with torch.no_grad():
+        generated = model.generate(
+            **encoded,
+            **generation_kwargs,
+        )
+    # 被取消的生成结果不完整，不写回会话缓存
+    job.check_cancelled()
+    if session is not None:
+        session_past = to_legacy_cache(generated.past_key_values)
+        cached_length = session_past[0][0].shape[2]
+        session_store.update_cache(session, generated.sequences[0, :cached_length].tolist(), session_past)
+        generated = generated.sequences
+    generated_tokens = generated[0, encoded["input_ids"].shape[-1]:]
+    record_generation(job, start, len(generated_tokens))
+    if speculative:
+        log_speculative_stats(len(generated_tokens), streamer.steps)
+    return tokenizer.decode(generated_tokens, skip_special_tokens=True).strip()
+
+
+def record_generation(job, start, tokens):
+    """按生成开始时间与首个 token 的时间点，把 prefill / decode 耗时写入 job.timings"""
+    end = time.perf_counter()
+    first = job.first_token_at or end
+    job.timings.update(prefill=first - start, decode=end - first, tokens=tokens)
+
+
+def job_timings(route, job):
+    """汇总本地推理任务各阶段的耗时（毫秒）并记录到指标中，作为响应的 timings 字段"""
+    queue_wait = job.queue_wait
+    STAGE_SECONDS.observe(queue_wait, route=route, stage="queue_wait")
+    timings = {"queue_wait_ms": round(queue_wait * 1000, 1)}
+    if job.first_token_at is not None:
+        ttft = job.first_token_at - job.enqueued_at
+        STAGE_SECONDS.observe(ttft, route=route, stage="ttft")
+        timings["ttft_ms"] = round(ttft * 1000, 1)
+    if "prefill" in job.timings:
+        STAGE_SECONDS.observe(job.timings["prefill"], route=route, stage="prefill")
+        timings["prefill_ms"] = round(job.timings["prefill"] * 1000, 1)
+    if "decode" in job.timings:
+        decode, tokens = job.timings["decode"], job.timings.get("tokens", 0)
+        STAGE_SECONDS.observe(decode, route=route, stage="decode")
+        GENERATED_TOKENS.inc(tokens, route=route)
+        timings.update(decode_ms=round(decode * 1000, 1), tokens=tokens)
+        # 首个 token 由 prefill 产生，解码速度只统计之后的 token
+        if decode > 0 and tokens > 1:
+            rate = (tokens - 1) / decode
+            DECODE_RATE.observe(rate, route=route)
+            timings["tokens_per_s"] = round(rate, 2)
+    timings["total_ms"] = round((time.perf_counter() - job.enqueued_at) * 1000, 1)
+    return timings
+
+
+def backend_timings(route, start):
+    """记录上游 / 辅助后端调用的耗时，返回响应的 timings 字段"""
+    elapsed = time.perf_counter() - start
+    STAGE_SECONDS.observe(elapsed, route=route, stage="backend")
+    return {"backend_ms": round(elapsed * 1000, 1)}
+
+
+speculative_stats = {"requests": 0, "tokens": 0, "steps": 0}
+
+
+def log_speculative_stats(tokens, steps):
+    """记录投机解码的接受情况：每个主模型步骤都产出 1 个自己的 token，其余均为被接受的草稿 token"""
+    steps = max(steps, 1)
+    speculative_stats["requests"] += 1
+    speculative_stats["tokens"] += tokens
+    speculative_stats["steps"] += steps
+    accepted = max(tokens - steps, 0)
+    total_accepted = max(speculative_stats["tokens"] - speculative_stats["steps"], 0)
+    print(f"🎯 投机解码: {tokens} tokens / {steps} 步 ({tokens / steps:.2f} tokens/步)，"
+          f"草稿接受 {accepted} 个 ({accepted / max(tokens, 1):.0%})；"
+          f"累计 {speculative_stats['tokens'] / speculative_stats['steps']:.2f} tokens/步，"
+          f"草稿占比 {total_accepted / max(speculative_stats['tokens'], 1):.0%}")
+
+
+def load_draft_model():
+    """加载投机解码使用的草稿模型（需与主模型共享分词器，例如 Qwen3-0.6B）"""
+    draft_path = speculative_config.get('draft_model', './models/Qwen3-0.6B')
+    if not os.path.exists(draft_path):
+        print(f"⚠️ 未找到草稿模型 {draft_path}，投机解码未启用")
+        return None
+    print(f"📦 正在加载草稿模型: {draft_path}")
+    draft = AutoModelForCausalLM.from_pretrained(
+        draft_path,
+        torch_dtype=torch.float16 if DEVICE == "cuda" else torch.float32,
+        low_cpu_mem_usage=True,
+    ).to(DEVICE)
+    draft.eval()
+    draft.generation_config.num_assistant_tokens = int(speculative_config.get('num_assistant_tokens', 5))
+    draft.generation_config.num_assistant_tokens_schedule = speculative_config.get('schedule', 'heuristic')
+    # 草稿模型对下一个 token 的置信度低于该阈值时提前结束本轮草稿
+    draft.generation_config.assistant_confidence_threshold = float(speculative_config.get('confidence_threshold', 0.4))
+    return draft
+
+
+@api.post("/chat")
+async def create_chat(request: Request):
+    json_post_list = await request.json()
+    prompt, history = parse_request(json_post_list)
+    priority = parse_priority(json_post_list.get('priority'))
+    request_id = json_post_list.get('request_id')
+    log_request(prompt)
+    history, text, prompt_tokens = await compact_for_prompt(
+        history + [{'role': 'user', 'content': prompt}], priority)
+    print("✅ 聊天模板应用完成")
+
+    max_new_tokens, temperature, top_p = parse_generation_params(json_post_list)
+    max_new_tokens = clamp_new_tokens(max_new_tokens, prompt_tokens)
+    # 使用 MLX 进行推理
+    print(f"💬 使用 {ENGINE.upper()} 引擎进行推理...")
+    print(f"📊 最大生成长度: {max_new_tokens} tokens (提示词 {prompt_tokens} tokens)")
+    stream = bool(json_post_list.get('stream', False))
+
+    try:
+        job = inference_worker.submit(
+            run_chat_job, text, history, max_new_tokens, temperature, top_p, stream=stream, priority=priority,
+            request_id=request_id)
+    except QueueFullError as e:
+        return busy_response(e, history)
+    print(f"📋 已加入推理队列 (排队中: {inference_worker.depth})")
+
+    def build_response(reply):
+        log_response(reply)
+        return create_response(reply, history + [{"role": "assistant", "content": reply}])
+
+    return await job_response("/chat", job, history, stream, build_response, request)
+
+
+async def wait_for_job(job, request=None):
+    """等待任务结果；客户端在等待期间断开连接时取消任务，生成会在下一个 token 处停止"""
+    if request is None:
+        return await job.future
+    while True:
+        done, _ = await asyncio.wait({job.future}, timeout=0.5)
+        if done:
+            return job.future.result()
+        if await request.is_disconnected():
+            print(f"🔌 客户端已断开连接，取消任务 #{job.id}")
+            job.cancel()
+            return await job.future
+
+
+async def job_response(route, job, history, stream, build_response, request=None):
+    """等待推理任务完成并返回响应；stream 为真时以 SSE 逐段推送 {"delta": ...}，最后以 done 事件返回完整响应
+
+    响应中的 timings 为该任务各阶段的耗时，同时按 route 记录到 /metrics。
+    """
+    if stream:
+        print("🌊 流式生成回复...")
+
+        async def event_stream():
+            try:
+                async for piece in job.iter_deltas():
+                    yield sse_event({"delta": piece})
+                try:
+                    reply = await job.future
+                except Exception as e:
+                    error_msg = f"流式生成错误: {str(e)}"
+                    print(f"❌ {error_msg}")
+                    if isinstance(e, JobCancelledError):
+                        status = 499
+                    elif isinstance(e, (QueueFullError, QueueTimeoutError)):
+                        # 排队中的后台任务被交互任务挤掉，或排队超时
+                        status = 429
+                    else:
+                        status = 500
+                    yield sse_event(create_response(error_msg, history, status=status), event="error")
+                    return
+                print(f"✅ 回复生成完成 (长度: {len(reply)} 字符)")
+                yield sse_event({**build_response(reply), "timings": job_timings(route, job)}, event="done")
+            finally:
+                # 客户端中途断开时 StreamingResponse 会关闭生成器
+                if not job.future.done():
+                    print(f"🔌 客户端已断开连接，取消任务 #{job.id}")
+                    job.cancel()
+
+        return StreamingResponse(event_stream(), media_type="text/event-stream")
+
+    try:
+        reply = await wait_for_job(job, request)
+    except (QueueFullError, QueueTimeoutError) as e:
+        # 排队中的后台任务可能被 _drop_background 丢弃
+        return busy_response(e, history)
+    except JobCancelledError as e:
+        return cancelled_response(e, history)
 
     print(f"✅ 回复生成完成 (长度: {len(reply)} 字符)")
+    return {**build_response(reply), "timings": job_timings(route, job)}
 
-    history.append({"role": "assistant", "content": reply})
 
-    log_response(reply)
-    return create_response(reply, history)
+def run_classify_job(job, text, history, labels, adapter_name=None):
+    """在推理线程中为每个候选标签打分（标签后接结束符，按平均 token 对数似然计算）"""
+    start = time.perf_counter()
+    prompt_ids = tokenizer.encode(text)
+    continuations = [tokenizer.encode(label) + [tokenizer.eos_token_id] for label in labels]
+    if ENGINE == "mlx":
+        scores = score_continuations_mlx(model, prompt_ids, continuations)
+    else:
+        prefix_length = system_prefix_length(history, prompt_ids) if prefix_cache is not None else 0
+
+        def score():
+            return score_continuations(
+                model, prompt_ids, continuations, DEVICE,
+                past=cached_system_prefix(prompt_ids, prefix_length, adapter_name),
+                pad_token_id=tokenizer.pad_token_id or 0,
+                adapter_name=adapter_name,
+            )
 
+        # 启用批处理时调度器正在同一个模型上解码，打分（含前缀缓存的填充）交给调度器线程在两个解码步之间执行
+        scores = model_call(score)
+    # 分类只有一次 prefill，没有解码阶段
+    job.timings["prefill"] = time.perf_counter() - start
+    return scores
 
-@api.post("/qwen3")
-async def create_qwen3_chat(request: Request):
+
+@api.post("/classify")
+async def create_classify(request: Request):
+    """从候选标签中选出给定对话下似然最高的一个，只需一次 prefill，不做自回归生成"""
     json_post_list = await request.json()
     prompt, history = parse_request(json_post_list)
+    history = (history or []) + [{'role': json_post_list.get('role', 'user'), 'content': prompt}]
+    labels = [str(label) for label in json_post_list.get('labels', []) if str(label)]
+    priority = parse_priority(json_post_list.get('priority'))
+    log_request(prompt)
+    if not labels:
+        return JSONResponse(status_code=400, content=create_response("labels 不能为空", history, status=400))
+
+    text = tokenizer.apply_chat_template(
+        history,
+        tokenize=False,
+        add_generation_prompt=True,
+        enable_thinking=False,
+    )
+    try:
+        # 启用进程内辅助模型时，分类同样属于辅助任务，使用禁用 LoRA 的基础模型；
+        # 打分经 model_call 在调度器线程中执行，不会与混合适配器的解码步同时进行
+        job = inference_worker.submit(
+            run_classify_job, text, history, labels,
+            adapter_name=BASE_ADAPTER if helper_in_process else None, priority=priority,
+            request_id=json_post_list.get('request_id'))
+        scores = await wait_for_job(job, request)
+    except (QueueFullError, QueueTimeoutError) as e:
+        return busy_response(e, history)
+    except JobCancelledError as e:
+        return cancelled_response(e, history)
+
+    label = labels[max(range(len(labels)), key=lambda i: scores[i])]
+    log_response(label)
+    response = create_response(label, history + [{'role': 'assistant', 'content': label}])
+    response["scores"] = dict(zip(labels, scores))
+    response["timings"] = job_timings("/classify", job)
+    return response
+
+
+# 辅助函数：创建会话响应（不回传完整历史，保持响应大小恒定）
+def create_session_response(response_text, session, status=200):
+    return {
+        "response": response_text,
+        "session_id": session.id,
+        "turns": len(session.history),
+        "status": status,
+        "time": get_current_time()
+    }
+
+
+@api.post("/sessions/{session_id}/chat")
+async def create_session_chat(session_id: str, request: Request):
+    json_post_list = await request.json()
+    prompt = json_post_list.get('prompt')
     role = json_post_list.get('role', 'user')
+    priority = parse_priority(json_post_list.get('priority'))
     log_request(prompt)
-    if prompt != "":
-        history = history + [{'role': role, 'content': prompt}]
 
-    config = get_config()
+    # 首次使用时创建会话，系统提示词默认使用丛雨人设
+    session = session_store.get_or_create(session_id, json_post_list.get('history') or identity())
+    running = session.running_job
+    if priority < PRIORITY_BACKGROUND and running is not None and running.priority >= PRIORITY_BACKGROUND:
+        # 后台轮次持有会话锁直到生成结束，交互请求不应排在它后面等待，直接取消，生成在下一个 token 处停止
+        print(f"🛑 会话 {session_id} 收到交互请求，取消进行中的后台任务 #{running.id}")
+        running.cancel()
+    await session.lock.acquire()
+    history = session.history + list(json_post_list.get('context', [])) + [{'role': role, 'content': prompt}]
+    try:
+        history, text, prompt_tokens = await compact_for_prompt(history, priority)
+    except Exception:
+        session.lock.release()
+        raise
+    print(f"💬 会话 {session_id} (第 {len(history)} 条消息) 使用 {ENGINE.upper()} 引擎进行推理...")
+
+    max_new_tokens, temperature, top_p = parse_generation_params(json_post_list)
+    max_new_tokens = clamp_new_tokens(max_new_tokens, prompt_tokens)
+    stream = bool(json_post_list.get('stream', False))
+
+    try:
+        job = inference_worker.submit(
+            run_chat_job, text, history, max_new_tokens, temperature, top_p,
+            session=session, stream=stream, priority=priority, request_id=json_post_list.get('request_id'))
+    except QueueFullError as e:
+        session.lock.release()
+        return busy_response(e, [])
+    session.running_job = job
+    print(f"📋 已加入推理队列 (排队中: {inference_worker.depth})")
+
+    def on_done(future):
+        # 任务结束（无论客户端是否还在读取）即更新历史并释放会话锁
+        try:
+            if not future.cancelled() and future.exception() is None:
+                session.history = history + [{"role": "assistant", "content": future.result()}]
+        finally:
+            if session.running_job is job:
+                session.running_job = None
+            session.lock.release()
+
+    job.future.add_done_callback(on_done)
+
+    def build_response(reply):
+        log_response(reply)
+        return create_session_response(reply, session)
+
+    return await job_response("/sessions/{session_id}/chat", job, [], stream, build_response, request)
+
+
+@api.get("/sessions/{session_id}")
+async def get_session(session_id: str):
+    session = session_store.get(session_id)
+    if session is None:
+        return JSONResponse(status_code=404, content={"status": 404, "response": f"会话不存在: {session_id}"})
+    return {**session.info(), "history": session.history, "status": 200}
+
+
+@api.delete("/sessions/{session_id}")
+async def delete_session(session_id: str):
+    deleted = session_store.delete(session_id)
+    return {"session_id": session_id, "deleted": deleted, "status": 200}
+
+
+@api.post("/cancel/{request_id}")
+async def cancel_request(request_id: str):
+    """取消请求时携带 request_id 的本地推理任务：排队中的任务直接结束，正在生成的任务在下一个 token 处停止"""
+    cancelled = inference_worker.cancel(request_id)
+    print(f"🛑 取消请求 {request_id}: {cancelled} 个任务")
+    return {"request_id": request_id, "cancelled": cancelled, "status": 200}
+
+
+async def request_qwen3(config, history, use_openrouter, schema=None, priority=PRIORITY_INTERACTIVE):
+    """调用 qwen3 后端，返回回复文本；传入 schema 时要求后端按该 JSON Schema 输出"""
     api_key = config.get('openrouter_api_key', '')
     endpoint_url = config.get('server', {}).get('qwen3', '')
 
-    # 仅当 endpoint 指向 openrouter 且 API key 存在时，才使用 OpenRouter
-    if "openrouter.ai" in endpoint_url and api_key.strip():
+    if use_openrouter:
         print(f"🌐 检测到 qwen3 endpoint 指向 OpenRouter，使用 API Key 进行调用...")
-        try:
-            result = call_openrouter_api(
+        final_response = await call_with_hedge(
+            lambda: call_openrouter_api(
                 config,
                 api_key,
                 "qwen/qwen3-235b-a22b",
                 history,
-                max_tokens=4096
-            )
-            final_response = result['choices'][0]['message']['content']
-            print("✅ OpenRouter API 调用成功")
-        except Exception as e:
-            error_msg = f"OpenRouter API 错误: {str(e)}"
-            print(f"❌ {error_msg}")
-            log_response(error_msg)
-            return create_response(error_msg, history, status=500)
-    else:
-        # 使用本地端点 (Ollama 或其他)
-        print(f"🏠 使用本地端点 ({endpoint_url}) 进行调用...")
-        response = None
+                max_tokens=4096,
+                schema=schema,
+                priority=priority
+            ),
+            "qwen3:14b",
+            history,
+            schema=schema,
+            priority=priority,
+        )
+        print("✅ OpenRouter API 调用成功")
+        return final_response
+
+    # 使用本地端点 (Ollama 或其他)
+    print(f"🏠 使用本地端点 ({endpoint_url}) 进行调用...")
+    try:
+        final_response = await call_ollama_api(endpoint_url, "qwen3:14b", history, schema=schema, priority=priority)
+        print("✅ 本地 API 调用成功")
+        return final_response
+    except UpstreamError as e:
+        print(f"❌ 调用本地 API 时出错: {e}")
+        raise
+
+
+@api.post("/qwen3")
+async def create_qwen3_chat(request: Request):
+    json_post_list = await request.json()
+    prompt, history = parse_request(json_post_list)
+    role = json_post_list.get('role', 'user')
+    priority = parse_priority(json_post_list.get('priority'))
+    log_request(prompt)
+    if prompt != "":
+        history = history + [{'role': role, 'content': prompt}]
+
+    config = get_config()
+    use_openrouter = qwen3_uses_openrouter(config)
+
+    schema = None
+    constraint = json_post_list.get('constraint')
+    if constraint is not None:
         try:
-            response = requests.post(
-                f"{endpoint_url}/api/chat",
-                json={"model": "qwen3:14b", "messages": history,
-                      "stream": False, "options": {"keep_alive": -1}},
-            )
-            response.raise_for_status() # 检查 HTTP 错误
-            final_response = response.json()['message']['content']
-            print("✅ 本地 API 调用成功")
-        except requests.exceptions.RequestException as e:
-            print(f"❌ 调用本地 API 时出错: {e}")
-            if response is not None:
-                print(f"响应状态: {response.status_code}")
-                print(f"响应内容: {response.text[:500]}")
+            options = resolve_options(constraint)
+        except ValueError as e:
+            return JSONResponse(status_code=400, content=create_response(str(e), history, status=400))
+        if constrained_backend == "local" or helper_in_process:
+            return await constrained_local_response(history, options, priority, json_post_list.get('request_id'))
+        # 由后端按 JSON Schema 做语法约束，选项包装在 value 字段中
+        schema = {
+            "type": "object",
+            "properties": {"value": {"type": "string", "enum": options}},
+            "required": ["value"],
+            "additionalProperties": False,
+        }
+
+    start = time.perf_counter()
+    try:
+        final_response = await complete_qwen3(config, history, schema=schema,
+                                              max_new_tokens=parse_generation_params(json_post_list)[0],
+                                              priority=priority, request_id=json_post_list.get('request_id'))
+        if schema is not None:
+            final_response = unwrap_constrained(final_response, options)
+    except (QueueFullError, QueueTimeoutError) as e:
+        return busy_response(e, history)
+    except JobCancelledError as e:
+        return cancelled_response(e, history)
+    except Exception as e:
+        if helper_in_process or not use_openrouter:
             raise
+        error_msg = f"OpenRouter API 错误: {str(e)}"
+        print(f"❌ {error_msg}")
+        log_response(error_msg)
+        return create_response(error_msg, history, status=500)
 
     history = history + [{'role': 'assistant', 'content': final_response}]
     log_response(final_response)
-    return create_response(final_response, history)
+    response = create_response(final_response, history)
+    response["timings"] = backend_timings("/qwen3", start)
+    return response
 
 
-@api.post("/qwenvl")
-async def create_qwenvl_chat(request: Request):
-    json_post_list = await request.json()
-    prompt, history = parse_request(json_post_list)
-    log_request(prompt)
+async def complete_qwen3(config, history, schema=None, max_new_tokens=2048, priority=PRIORITY_INTERACTIVE,
+                         request_id=None):
+    """执行一次 qwen3 辅助生成，返回回复文本
 
-    if "image" in json_post_list:
-        image_url = json_post_list.get('image')
-        print(f"🖼️ 检测到图像输入: {image_url[:100]}...")
-        history = history + [{'role': 'user', 'content': prompt, 'images': [image_url]}]
-    else:
-        print("📝 纯文本模式（无图像输入）")
-        history = history + [{'role': 'user', 'content': prompt}]
+    启用 helper_in_process 时在本地模型上禁用 LoRA 生成（与对话请求共享批处理），
+    否则交给配置的 Ollama / OpenRouter 后端；本地生成不支持 schema，由调用方负责解析。
+    相同的请求优先从响应缓存返回，或与同一优先级下进行中的相同请求合并。
+    合并后的计算由多个请求共享，因此不携带 request_id：取消其中一个请求不会让其他等待者一起失败。
+    """
+    async def generate(request_id=None):
+        if helper_in_process:
+            text = tokenizer.apply_chat_template(
+                history,
+                tokenize=False,
+                add_generation_prompt=True,
+                enable_thinking=False,
+            )
+            job = inference_worker.submit(
+                run_chat_job, text, history, max_new_tokens, 0.7, 0.9, adapter_name=BASE_ADAPTER, priority=priority,
+                request_id=request_id)
+            return await job.future
+        return await request_qwen3(config, history, qwen3_uses_openrouter(config), schema=schema, priority=priority)
+
+    if response_cache is None:
+        return await generate(request_id)
+    key = cache_key(qwen3_backend(config), history, schema=schema, max_new_tokens=max_new_tokens)
+    return await response_cache.get_or_compute(key, generate, group=priority)
+
+
+def qwen3_backend(config):
+    """qwen3 辅助请求实际使用的后端与模型，作为响应缓存键的一部分"""
+    if helper_in_process:
+        return "local:base"
+    if qwen3_uses_openrouter(config):
+        return "openrouter:qwen/qwen3-235b-a22b"
+    return f"ollama:{config.get('server', {}).get('qwen3', '')}:qwen3:14b"
+
+
+@functools.lru_cache(maxsize=16)
+def build_constraint(options):
+    # 图层列表的选项多达上千个，前缀树按选项集合缓存
+    return AllowedSequences(tokenizer, options, [tokenizer.eos_token_id])
+
+
+def unwrap_constrained(text, options):
+    """取出结构化输出中的 value；后端未遵守约束时原样返回"""
+    result = format_bot_response(text.split("</think>")[-1].strip())
+    if isinstance(result, dict) and result.get('value') in options:
+        return result['value']
+    print(f"⚠️ 后端返回的内容不符合约束: {text[:100]}")
+    return text
+
+
+async def constrained_local_response(history, options, priority=PRIORITY_INTERACTIVE, request_id=None):
+    """在本地模型上做受限解码，只需生成选项本身的几个 token"""
+    text = tokenizer.apply_chat_template(
+        history,
+        tokenize=False,
+        add_generation_prompt=True,
+        enable_thinking=False,
+    )
+    constraint = build_constraint(tuple(options))
+    print(f"🔒 本地受限解码 ({len(options)} 个候选)")
+    try:
+        # 启用批处理时作为批次中的一行解码，禁用 LoRA 的辅助请求可以与对话请求混合在同一批次中
+        job = inference_worker.submit(
+            run_chat_job, text, history, constraint.max_length + 1, 0.0, 1.0, constraint=constraint,
+            adapter_name=BASE_ADAPTER if helper_in_process else None, priority=priority, request_id=request_id)
+        final_response = await job.future
+    except (QueueFullError, QueueTimeoutError) as e:
+        return busy_response(e, history)
+    except JobCancelledError as e:
+        return cancelled_response(e, history)
+
+    history = history + [{'role': 'assistant', 'content': final_response}]
+    log_response(final_response)
+    response = create_response(final_response, history)
+    response["timings"] = job_timings("/qwen3", job)
+    return response
+
+
+def qwen3_uses_openrouter(config):
+    # 仅当 endpoint 指向 openrouter 且 API key 存在时，才使用 OpenRouter
+    endpoint_url = config.get('server', {}).get('qwen3', '')
+    return bool("openrouter.ai" in endpoint_url and config.get('openrouter_api_key', '').strip())
+
+
+def parse_postprocess(text, labels):
+    """解析并校验后处理结果，无法解析时返回 None"""
+    result = format_bot_response(text.split("</think>")[-1].strip())
+    if not isinstance(result, dict) or not isinstance(result.get('translation'), str) or not result['translation'].strip():
+        return None
+    return {
+        "translation": result['translation'].strip(),
+        "emotion": normalize_emotion(result.get('emotion'), labels),
+        "layers": normalize_layers(result.get('layers')),
+    }
+
+
+def normalize_emotion(emotion, labels):
+    emotion = str(emotion or "").strip()
+    if labels and emotion not in labels:
+        print(f"⚠️ 情感标签 {emotion} 不在可选标签中，使用默认值")
+        return "平静"
+    return emotion
+
+
+def normalize_layers(layers):
+    if isinstance(layers, str):
+        layers = format_bot_response(layers.split("</think>")[-1].strip())
+    if not isinstance(layers, list):
+        return []
+    try:
+        return [int(layer) for layer in layers]
+    except (TypeError, ValueError):
+        return []
+
+
+async def postprocess_separately(config, prompt, response, layer_type, labels, priority=PRIORITY_INTERACTIVE,
+                                 request_id=None):
+    """回退路径：翻译、情感、图层三个请求同时提交"""
+    def helper(system_prompt, content):
+        return [{"role": "system", "content": system_prompt}, {"role": "user", "content": content + "/no_think"}]
+
+    translated, emotion, layers = await asyncio.gather(
+        complete_qwen3(config, helper(TRANSLATE_PROMPT, response), priority=priority, request_id=request_id),
+        complete_qwen3(config, helper(emotion_prompt(labels), f"用户：{prompt}\n丛雨：{response}"),
+                       priority=priority, request_id=request_id),
+        complete_qwen3(config, helper(layer_prompt(layer_type), response), priority=priority, request_id=request_id),
+    )
+    return {
+        "translation": translated.split("</think>")[-1].strip(),
+        "emotion": normalize_emotion(emotion.split("</think>")[-1], labels),
+        "layers": normalize_layers(layers),
+    }
+
+
+@api.post("/postprocess")
+async def create_postprocess(request: Request):
+    """一次生成同时返回回复的日文翻译、情感标签与立绘图层
+
+    优先使用一次 JSON 结构化生成；结果无法解析时回退为三个并发的辅助请求。
+    """
+    json_post_list = await request.json()
+    prompt = json_post_list.get('prompt', '')
+    response = json_post_list.get('response', '')
+    layer_type = json_post_list.get('type', 'b')
+    labels = json_post_list.get('emotions') or default_emotion_labels()
+    priority = parse_priority(json_post_list.get('priority'))
+    request_id = json_post_list.get('request_id')
+    log_request(response)
+    if layer_type not in ('a', 'b'):
+        return JSONResponse(status_code=400, content={"status": 400, "response": f"未知的立绘类型: {layer_type}"})
 
     config = get_config()
+    history = [
+        {"role": "system", "content": postprocess_prompt(labels, layer_type)},
+        {"role": "user", "content": f"用户：{prompt}\n丛雨：{response}/no_think"},
+    ]
+
+    mode = "combined"
+    start = time.perf_counter()
+    try:
+        result = parse_postprocess(
+            await complete_qwen3(config, history, schema=postprocess_schema(labels), priority=priority,
+                                 request_id=request_id), labels)
+        if result is None:
+            print("⚠️ 结构化后处理结果无法解析，回退为并发的独立请求")
+            mode = "separate"
+            result = await postprocess_separately(config, prompt, response, layer_type, labels, priority, request_id)
+    except (QueueFullError, QueueTimeoutError) as e:
+        return busy_response(e, [])
+    except JobCancelledError as e:
+        return cancelled_response(e, [])
+    except Exception as e:
+        error_msg = f"后处理错误: {str(e)}"
+        print(f"❌ {error_msg}")
+        return JSONResponse(status_code=500, content={"status": 500, "response": error_msg})
+
+    print(f"✅ 后处理完成 ({mode}): {result}")
+    return {**result, "mode": mode, "status": 200, "time": get_current_time(),
+            "timings": backend_timings("/postprocess", start)}
+
+
+def default_emotion_labels():
+    # 客户端未提供标签时，尝试读取服务端本地的参考音频目录
+    reference_dir = './models/Murasame_SoVITS/reference_voices'
+    return os.listdir(reference_dir) if os.path.isdir(reference_dir) else []
+
+
+async def request_qwenvl(config, history, image_url, use_openrouter, priority=PRIORITY_INTERACTIVE):
+    """调用 qwenvl 后端，返回回复文本"""
     api_key = config.get('openrouter_api_key', '')
     endpoint_url = config.get('server', {}).get('qwenvl', '')
-    image_url_for_api = json_post_list.get('image') if "image" in json_post_list else None
 
-    # 仅当 endpoint 指向 openrouter 且 API key 存在时，才使用 OpenRouter
-    if "openrouter.ai" in endpoint_url and api_key.strip():
+    if use_openrouter:
         print(f"🌐 检测到 qwenvl endpoint 指向 OpenRouter，使用 API Key 进行调用...")
-        try:
-            result = call_openrouter_api(
+        final_response = await call_with_hedge(
+            lambda: call_openrouter_api(
                 config,
                 api_key,
                 "qwen/qwen-2.5-vl-7b-instruct",
                 history,
-                image_url=image_url_for_api
-            )
-            final_response = result['choices'][0]['message']['content']
-            print("✅ OpenRouter 视觉 API 调用成功")
-        except Exception as e:
-            error_msg = f"OpenRouter API 错误: {str(e)}"
-            print(f"❌ {error_msg}")
-            log_response(error_msg)
-            return create_response(error_msg, history, status=500)
+                image_url=image_url,
+                priority=priority
+            ),
+            "qwen2.5vl:7b",
+            history,
+            priority=priority,
+        )
+        print("✅ OpenRouter 视觉 API 调用成功")
+        return final_response
+
+    # 使用本地端点 (Ollama 或其他)
+    print(f"🏠 使用本地端点 ({endpoint_url}) 进行调用...")
+    try:
+        final_response = await call_ollama_api(endpoint_url, "qwen2.5vl:7b", history, priority=priority)
+        print("✅ 本地视觉 API 调用成功")
+        return final_response
+    except UpstreamError as e:
+        print(f"❌ 调用本地视觉 API 时出错: {e}")
+        raise
+
+
+@api.post("/qwenvl")
+async def create_qwenvl_chat(request: Request):
+    json_post_list = await request.json()
+    prompt, history = parse_request(json_post_list)
+    log_request(prompt)
+
+    config = get_config()
+    api_key = config.get('openrouter_api_key', '')
+    endpoint_url = config.get('server', {}).get('qwenvl', '')
+    # 仅当 endpoint 指向 openrouter 且 API key 存在时，才使用 OpenRouter
+    use_openrouter = bool("openrouter.ai" in endpoint_url and api_key.strip())
+
+    image_url_for_api = None
+    image_hash = None
+    start = time.perf_counter()
+    if "image" in json_post_list:
+        image = json_post_list.get('image')
+        if not isinstance(image, str) or not image.strip():
+            return JSONResponse(status_code=400, content=create_response(
+                "image 必须是非空的图片链接或 base64 字符串", history, status=400))
+        if image.startswith(("http://", "https://")):
+            print(f"🖼️ 检测到图像链接: {image[:100]}")
+            image_url_for_api = image
+        else:
+            try:
+                # 解码与缩放大图较慢，放到线程中执行
+                image, image_hash, original_size, size = await asyncio.to_thread(
+                    prepare_image, image,
+                    max_pixels=int(vision_config.get('max_pixels', 1280 * 28 * 28)),
+                    quality=int(vision_config.get('jpeg_quality', 85)),
+                )
+            except ValueError as e:
+                return JSONResponse(status_code=400, content=create_response(str(e), history, status=400))
+            print(f"🖼️ 检测到图像输入: {original_size[0]}x{original_size[1]} -> {size[0]}x{size[1]} JPEG "
+                  f"({len(image) // 1024} KB)")
+            # OpenRouter 需要 data: URL，Ollama 的 images 字段使用纯 base64
+            image_url_for_api = f"data:image/jpeg;base64,{image}"
+        history = history + [{'role': 'user', 'content': prompt, 'images': [image]}]
     else:
-        # 使用本地端点 (Ollama 或其他)
-        print(f"🏠 使用本地端点 ({endpoint_url}) 进行调用...")
-        try:
-            response = requests.post(
-                f"{endpoint_url}/api/chat",
-                json={"model": "qwen2.5vl:7b", "messages": history,
-                      "stream": False, "options": {"keep_alive": -1}},
-            )
-            response.raise_for_status()
-            final_response = response.json()['message']['content']
-            print("✅ 本地视觉 API 调用成功")
-        except requests.exceptions.RequestException as e:
-            print(f"❌ 调用本地视觉 API 时出错: {e}")
+        print("📝 纯文本模式（无图像输入）")
+        history = history + [{'role': 'user', 'content': prompt}]
+
+    context_key = None
+    if image_cache is not None and image_hash is not None:
+        # 上下文键只包含后端与文字消息，图片由 dHash 比较
+        context_key = cache_key("openrouter" if use_openrouter else f"ollama:{endpoint_url}", history)
+        cached, distance = image_cache.get(context_key, image_hash)
+        if cached is not None:
+            print(f"♻️ 截图与缓存的画面相近 (dHash 距离 {distance})，复用视觉描述")
+            history = history + [{'role': 'assistant', 'content': cached}]
+            log_response(cached)
+            response = create_response(cached, history)
+            response["timings"] = backend_timings("/qwenvl", start)
+            response["cached"] = True
+            return response
+
+    try:
+        final_response = await request_qwenvl(config, history, image_url_for_api, use_openrouter,
+                                              priority=parse_priority(json_post_list.get('priority')))
+    except (QueueFullError, QueueTimeoutError) as e:
+        return busy_response(e, history)
+    except Exception as e:
+        if not use_openrouter:
             raise
+        error_msg = f"OpenRouter API 错误: {str(e)}"
+        print(f"❌ {error_msg}")
+        log_response(error_msg)
+        return create_response(error_msg, history, status=500)
 
+    if context_key is not None:
+        image_cache.put(context_key, image_hash, final_response)
     history = history + [{'role': 'assistant', 'content': final_response}]
     log_response(final_response)
-    return create_response(final_response, history)
+    response = create_response(final_response, history)
+    response["timings"] = backend_timings("/qwenvl", start)
+    return response
+
+
+@api.get("/health")
+async def health():
+    """就绪检查：预热完成前返回 503"""
+    if not readiness["ready"]:
+        return JSONResponse(status_code=503, content={"status": 503, "ready": False})
+    return {"status": 200, "ready": True, "engine": ENGINE, "warmup_seconds": readiness["warmup_seconds"]}
+
+
+@api.get("/metrics")
+async def metrics():
+    """Prometheus 文本格式的运行指标"""
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
 
 if __name__ == '__main__':
     print("=" * 60)
     print("🚀 MurasamePet API 服务启动中...")
     print("=" * 60)
     
+    if "--materialize" in sys.argv:
+        # 只生成合并权重缓存，不启动服务
+        if ENGINE != "torch":
+            print("⚠️ MLX 引擎加载的已经是合并后的模型，无需生成合并权重缓存")
+        else:
+            load_model_and_tokenizer(materialize=True)
+        sys.exit(0)
+
     model, tokenizer = load_model_and_tokenizer()
+
+    if prefix_cache is not None:
+        print("♻️ 正在预热系统提示词的前缀 KV 缓存...")
+        prefix_tokens = warm_prefix_cache(identity())
+        print(f"✅ 前缀缓存预热完成 ({prefix_tokens} tokens)")
+
+    if USE_SPECULATIVE:
+        draft_model = load_draft_model()
+        if draft_model is not None:
+            print(f"🎯 已启用投机解码 (每步草稿 token: {draft_model.generation_config.num_assistant_tokens})")
+
+    if COMPILE_DECODE:
+        COMPILE_DECODE = enable_compiled_decode()
+        if COMPILE_DECODE:
+            print("⚙️ 已启用编译解码步 (静态 KV 缓存 + torch.compile)，首次编译在预热阶段完成")
+
+    if helper_in_process:
+        print("🧩 已启用进程内辅助模型：/qwen3 在基础模型上禁用 LoRA 执行")
+
+    if USE_BATCHING:
+        scheduler = BatchScheduler(
+            model, tokenizer, DEVICE,
+            max_batch_size=max_batch_size,
+            prefix_cache=prefix_cache,
+        )
+        scheduler.start()
+        print(f"🧮 已启用连续批处理 (最大批大小: {max_batch_size})")
     
     print("=" * 60)
     print("✅ 模型加载完成，启动 FastAPI 服务器...")
     print(f"🌐 服务地址: http://0.0.0.0:28565")
     print(f"📡 可用端点:")
-    print(f"   - POST /chat    (主对话接口 - Murasame)")
+    print(f"   - POST /chat    (主对话接口 - Murasame，支持 stream=true 流式输出)")
+    print(f"   - POST /sessions/{{id}}/chat  (会话对话接口 - 服务端保存历史与 KV 缓存)")
     print(f"   - POST /qwen3   (通用问答接口 - Qwen3)")
+    print(f"   - POST /classify     (分类接口 - 按似然从候选标签中选择)")
+    print(f"   - POST /postprocess  (后处理接口 - 一次返回翻译、情感与立绘图层)")
     print(f"   - POST /qwenvl  (视觉理解接口 - Qwen-VL)")
+    print(f"   - POST /cancel/{{request_id}}  (取消接口 - 停止携带该 request_id 的生成)")
+    print(f"   - GET  /health  (就绪检查 - 预热完成后返回 200)")
+    print(f"   - GET  /metrics (运行指标 - Prometheus 文本格式)")
     print("=" * 60)
     
     uvicorn.run(api, host='0.0.0.0', port=28565, workers=1)
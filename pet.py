@@ -1,25 +1,78 @@
-from PyQt5.QtMultimedia import QSound
+from PyQt5.QtMultimedia import QAudio, QAudioFormat, QAudioOutput
 from PyQt5.QtWidgets import QApplication, QLabel, QSystemTrayIcon, QMenu, QAction, QGraphicsOpacityEffect
 from PyQt5.QtGui import QPixmap, QIcon, QImage, QFont, QPainter, QFontDatabase, QColor
-from PyQt5.QtCore import Qt, QTimer, QThread, pyqtSignal, QEvent, QRect, QSize, pyqtProperty
+from PyQt5.QtCore import Qt, QTimer, QThread, pyqtSignal, QEvent, QRect, QSize, pyqtProperty, QObject, QBuffer, QIODevice
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 from datetime import datetime
+from io import BytesIO
 from Murasame import chat, generate, utils
-import hashlib
 import cv2
 import threading
+import queue
 import textwrap
+import wave
 import os
 import time
 import sys
 import json
 import traceback
 import pyautogui
+import uuid
 
 
 def wrap_text(text, width=12):
     return '\n'.join(textwrap.wrap(text, width=width, break_long_words=True, break_on_hyphens=False))
 
 
+# TTS 合成线程池：LLMWorker 提交后拿到 Future，合成完成即可取得 wav 数据
+tts_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="tts")
+
+
+class VoicePlayer(QObject):
+    """从内存播放 wav：解析 wav 头后把 PCM 数据经 QBuffer 交给 QAudioOutput，不经过文件"""
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.output = None
+        self.buffer = None
+
+    def play(self, data):
+        self.stop()
+        try:
+            with wave.open(BytesIO(data), "rb") as wav:
+                audio_format = QAudioFormat()
+                audio_format.setSampleRate(wav.getframerate())
+                audio_format.setChannelCount(wav.getnchannels())
+                audio_format.setSampleSize(wav.getsampwidth() * 8)
+                audio_format.setCodec("audio/pcm")
+                audio_format.setByteOrder(QAudioFormat.LittleEndian)
+                # 8 位 wav 为无符号整数，其余为有符号整数
+                audio_format.setSampleType(
+                    QAudioFormat.UnSignedInt if wav.getsampwidth() == 1 else QAudioFormat.SignedInt)
+                pcm = wav.readframes(wav.getnframes())
+        except (wave.Error, EOFError) as e:
+            print(f"Invalid wav data: {e}")
+            return
+        self.buffer = QBuffer(self)
+        self.buffer.setData(pcm)
+        self.buffer.open(QIODevice.ReadOnly)
+        self.output = QAudioOutput(audio_format, self)
+        self.output.start(self.buffer)
+
+    def is_playing(self):
+        return self.output is not None and self.output.state() == QAudio.ActiveState
+
+    def stop(self):
+        if self.output is not None:
+            self.output.stop()
+            self.output.deleteLater()
+            self.output = None
+        if self.buffer is not None:
+            self.buffer.close()
+            self.buffer.deleteLater()
+            self.buffer = None
+
+
 class Murasame(QLabel):
     # 显示预设配置
     DISPLAY_PRESETS = {
@@ -86,6 +139,8 @@ class Murasame(QLabel):
         self.history = chat.identity()
         self.emotion_history = []
         self.embeddings_history = []
+        # 启用服务端会话时，对话历史与 KV 缓存由 api.py 保存，每轮只发送新消息
+        self.session_id = uuid.uuid4().hex if config.get('user', {}).get('use_sessions', True) else None
 
         self._fade_bg = QLabel(self)
         self._fade_fg = QLabel(self)
@@ -175,6 +230,13 @@ class Murasame(QLabel):
 
         self.latest_response = "【 丛雨 】\n  主人，你好呀！"
 
+        self.voice_player = VoicePlayer(self)
+        # 逐句语音：按顺序播放 LLMWorker 合成好的句子，播放某一句时气泡显示该句
+        self.speech_queue = []
+        self.speech_reply_id = None
+        self.speech_timer = QTimer()
+        self.speech_timer.timeout.connect(self._speech_step)
+
     def _setup_macos_window_level(self):
         """在 macOS 上设置窗口层级，使其始终在最前但不抢占焦点"""
         import platform
@@ -289,8 +351,10 @@ class Murasame(QLabel):
         if self.touch_head and self.head_press_x is not None and event.buttons() & Qt.LeftButton:
             if abs(event.x() - self.head_press_x) > 50:
                 self.llm_worker = LLMWorker(
-                    "主人摸了摸你的头", self.history, self.emotion_history, self.embeddings_history, role="system")
+                    "主人摸了摸你的头", self.history, self.emotion_history, self.embeddings_history, role="system",
+                    session_id=self.session_id)
                 self.llm_worker.finished.connect(self.on_llm_result)
+                self.llm_worker.sentence_ready.connect(self.on_sentence_ready)
                 self.llm_worker.start()
                 self.touch_head = False
                 self.head_press_x = None
@@ -489,20 +553,22 @@ class Murasame(QLabel):
         if hasattr(screen_worker, "interrupt_event"):
             screen_worker.interrupt_event.set()
         self.llm_worker = LLMWorker(
-            self.input_buffer, self.history, self.emotion_history, self.embeddings_history, role="user")
+            self.input_buffer, self.history, self.emotion_history, self.embeddings_history, role="user",
+            session_id=self.session_id)
         self.llm_worker.finished.connect(self.on_llm_result)
+        self.llm_worker.sentence_ready.connect(self.on_sentence_ready)
         self.llm_worker.start()
 
-    def on_llm_result(self, result, history, emotion_history, embeddings_history, embeddings_layers, raw_response):
+    def on_llm_result(self, result, history, emotion_history, embeddings_history, embeddings_layers, audio):
         # 检查是否是错误信号
-        if raw_response == "Error" and not embeddings_layers:
+        if audio == "Error" and not embeddings_layers:
             self.show_text(result, typing=False)
             return
 
-        raw_response_md5 = hashlib.md5(raw_response.encode()).hexdigest()
-        voice_path = os.path.join(os.getcwd(), 'voices', f"{raw_response_md5}.wav")
-        QSound.play(voice_path)
-        self.show_text(result, typing=True)
+        # 逐句语音模式下 audio 为空，语音与气泡已由 on_sentence_ready 逐句播放
+        if audio:
+            self.voice_player.play(audio)
+            self.show_text(result, typing=True)
         self.latest_response = result
         self.input_buffer = ""
         self.preedit_text = ""
@@ -511,6 +577,27 @@ class Murasame(QLabel):
         self.embeddings_history = embeddings_history
         self.switch_image("b", embeddings_layers)
 
+    def on_sentence_ready(self, reply_id, sentence, audio):
+        if reply_id != self.speech_reply_id:
+            # 新一轮回复开始，丢弃上一轮还没播放的句子
+            self.speech_reply_id = reply_id
+            self.speech_queue = []
+            self.voice_player.stop()
+        self.speech_queue.append((sentence, audio))
+        if not self.speech_timer.isActive():
+            self._speech_step()
+            self.speech_timer.start(100)
+
+    def _speech_step(self):
+        if self.voice_player.is_playing():
+            return
+        if not self.speech_queue:
+            self.speech_timer.stop()
+            return
+        sentence, audio = self.speech_queue.pop(0)
+        self.voice_player.play(audio)
+        self.show_text(f"「{wrap_text(sentence)}」", typing=True)
+
     def keyPressEvent(self, event):
         if self.input_mode:
             if event.key() in (Qt.Key_Return, Qt.Key_Enter):
@@ -611,19 +698,23 @@ class ScreenWorker(QThread):
                 try:
                     screenshot = pyautogui.screenshot()
                     sys_prompt = '''你现在要担任一个AI桌宠的视觉识别助手，我会向你提供用户此时的屏幕截图，你要识别用户此时的行为，并进行描述。我会将你的描述以system消息提供给另外一个处理语言的AI模型。'''
+                    # 屏幕观察属于后台任务，服务端繁忙时会被直接丢弃，不影响用户的对话
                     response, _ = chat.query_image(screenshot, "现在请描述用户此时的行为", [
-                        {"role": "system", "content": sys_prompt}])
+                        {"role": "system", "content": sys_prompt}], priority="background")
                     des, self.history = chat.think_image(
-                        response, self.history)
+                        response, self.history, priority="background")
                     if des.get('des'):
                         print("scr worker：", des['des'])
                         self.llmworker = LLMWorker(
-                            des['des'], self.history, [], [], role="system", interrupt_event=self.interrupt_event
+                            des['des'], self.history, [], [], role="system", interrupt_event=self.interrupt_event,
+                            priority="background"
                         )
                         self.screen_result.emit(des['des'])
 
                         self.llmworker.start()
                         self.llmworker.wait()
+                except chat.RequestDropped as e:
+                    print(f"scr worker：服务端繁忙，跳过本次屏幕观察 ({e})")
                 finally:
                     pass
             time.sleep(30)
@@ -638,18 +729,71 @@ class ScreenWorker(QThread):
 
 
 class LLMWorker(QThread):
-    finished = pyqtSignal(str, list, list, list, list, str)
+    # 最后一个参数为 wav 数据 (bytes)；逐句语音模式下为空，出错时为 "Error"
+    finished = pyqtSignal(str, list, list, list, list, object)
+    # (request_id, 中文句子, wav 数据)：逐句语音模式下每合成好一句发出一次
+    sentence_ready = pyqtSignal(str, str, object)
 
-    def __init__(self, prompt, history, emotion_history, embeddings_history, role="user", interrupt_event=None):
+    def __init__(self, prompt, history, emotion_history, embeddings_history, role="user", interrupt_event=None, session_id=None,
+                 priority="interactive"):
         super().__init__()
         self.prompt = prompt
+        self.session_id = session_id
         self.history = history
         self.role = role
+        # 只有屏幕观察触发的轮次为后台任务（服务端繁忙时会被丢弃），摸头等用户操作即使以 system 身份发送也属于交互任务
+        self.priority = priority
         self.emotion_history = emotion_history
         self.embeddings_history = embeddings_history
         self.interrupt_event = interrupt_event
+        self.request_id = None
 
     def run(self):
+        # 本轮的所有请求共用一个 request_id；interrupt_event 被设置时通知服务端停止仍在进行的生成
+        self.request_id = chat.new_request_id()
+        done = threading.Event()
+        if self.interrupt_event is not None:
+            threading.Thread(target=self._cancel_on_interrupt, args=(done,), daemon=True).start()
+        try:
+            self._run()
+        finally:
+            done.set()
+
+    def _speak_sentences(self, sentences, state):
+        """按顺序翻译每一句并合成语音；情感按首句判断，整轮回复共用
+
+        首句的情感结果写入 state["emotion_history"] 后（或线程提前结束时）设置 state["emotion_ready"]。
+        """
+        emotion = None
+        try:
+            while True:
+                sentence = sentences.get()
+                if sentence is None or (self.interrupt_event and self.interrupt_event.is_set()):
+                    return
+                if emotion is None:
+                    with ThreadPoolExecutor(max_workers=1) as pool:
+                        emotion_future = pool.submit(
+                            chat.get_emotion, f"用户：{self.prompt}\n丛雨：{sentence}", self.emotion_history,
+                            priority=self.priority)
+                        translated = chat.get_translate(sentence, priority=self.priority)
+                        emotion, state["emotion_history"] = emotion_future.result()
+                    state["emotion_ready"].set()
+                else:
+                    translated = chat.get_translate(sentence, priority=self.priority)
+                self.sentence_ready.emit(self.request_id, sentence, chat.generate_tts(translated, emotion))
+        except Exception as e:
+            print(f"Speech pipeline failed: {e}")
+        finally:
+            state["emotion_ready"].set()
+
+    def _cancel_on_interrupt(self, done):
+        while not done.is_set():
+            if self.interrupt_event.wait(0.2):
+                print(f"LLMWorker interrupted, cancelling request {self.request_id}")
+                chat.cancel_request(self.request_id)
+                return
+
+    def _run(self):
         try:
             t_start = time.time()
             hour = datetime.now().hour
@@ -662,58 +806,139 @@ class LLMWorker(QThread):
                 period = "下午"
             elif 18 <= hour < 24:
                 period = "晚上"
-            self.history.append(
-                {"role": "system", "content": f"现在是{period}{hour}点{minute}分"})
+            time_message = {"role": "system", "content": f"现在是{period}{hour}点{minute}分"}
+            self.history.append(time_message)
 
             if self.interrupt_event and self.interrupt_event.is_set():
                 print("LLMWorker interrupted before start")
                 return
 
-            response, history = chat.query(
-                prompt=self.prompt,
-                history=self.history,
-                role=self.role
-            )
+            # 逐句语音：流式接收回复，每凑齐一句就交给 speaker 线程翻译并合成，不必等整段回复生成完
+            speaker = None
+            on_token = None
+            if utils.get_config().get('user', {}).get('speech_streaming', False):
+                sentences = queue.Queue()
+                sentence_buffer = chat.SentenceBuffer()
+                speech_state = {"emotion_ready": threading.Event()}
+                speaker = threading.Thread(
+                    target=self._speak_sentences, args=(sentences, speech_state), daemon=True)
+                speaker.start()
+
+                def on_token(piece):
+                    for sentence in sentence_buffer.feed(piece):
+                        sentences.put(sentence)
+
+            try:
+                if self.session_id:
+                    response = chat.query_session(
+                        self.session_id,
+                        self.prompt,
+                        role=self.role,
+                        context=[time_message],
+                        history=chat.identity(),
+                        on_token=on_token,
+                        priority=self.priority,
+                        request_id=self.request_id
+                    )
+                    history = self.history + [
+                        {"role": self.role, "content": self.prompt},
+                        {"role": "assistant", "content": response}
+                    ]
+                else:
+                    response, history = chat.query(
+                        prompt=self.prompt,
+                        history=self.history,
+                        role=self.role,
+                        on_token=on_token,
+                        priority=self.priority,
+                        request_id=self.request_id
+                    )
+            except Exception:
+                if speaker is not None:
+                    sentences.put(None)
+                raise
 
             if self.interrupt_event and self.interrupt_event.is_set():
                 print("LLMWorker interrupted before start")
+                if speaker is not None:
+                    sentences.put(None)
                 return
 
-            translated = chat.get_translate(response)
-
-            if self.interrupt_event and self.interrupt_event.is_set():
-                print("LLMWorker interrupted before start")
+            if speaker is not None:
+                for sentence in sentence_buffer.flush():
+                    sentences.put(sentence)
+                sentences.put(None)
+                # 语音与气泡由 sentence_ready 逐句播放，这里只需要立绘图层
+                embeddings_layers, embeddings_history = chat.get_embedings_layers(
+                    response, "b", self.embeddings_history, priority=self.priority)
+                if self.interrupt_event and self.interrupt_event.is_set():
+                    return
+                print(time.time() - t_start, "sec")
+                result = f"「{wrap_text(response)}」"
+                # 等 speaker 线程写入首句的情感结果，否则更新后的情感历史会丢失
+                speech_state["emotion_ready"].wait()
+                self.finished.emit(result, history, speech_state.get("emotion_history", self.emotion_history),
+                                   embeddings_history, embeddings_layers, "")
+                speaker.join()
                 return
 
-            emotion, emotion_history = chat.get_emotion(
-                f"用户：{self.prompt}\n丛雨：{response}", self.emotion_history)
+            combined = utils.get_config().get('user', {}).get('postprocess_mode', 'combined') == 'combined'
+            if combined:
+                # 一次请求同时得到翻译、情感与立绘图层
+                try:
+                    translated, emotion, embeddings_layers = chat.get_postprocess(
+                        self.prompt, response, "b", priority=self.priority, request_id=self.request_id)
+                    emotion_history, embeddings_history = self.emotion_history, self.embeddings_history
+                except (chat.RequestDropped, chat.RequestCancelled):
+                    raise
+                except Exception as e:
+                    print(f"Postprocess failed, falling back to separate calls: {e}")
+                    combined = False
 
-            if self.interrupt_event and self.interrupt_event.is_set():
-                print("LLMWorker interrupted before start")
-                return
+            if combined:
+                if self.interrupt_event and self.interrupt_event.is_set():
+                    print("LLMWorker interrupted before start")
+                    return
 
-            tts_thread = threading.Thread(
-                target=chat.generate_tts, args=(translated, emotion), daemon=True)
-            tts_thread.start()
+                tts_future = tts_executor.submit(chat.generate_tts, translated, emotion)
+            else:
+                # 翻译、情感、立绘图层都只依赖中文回复，三者同时请求；
+                # TTS 依赖翻译与情感，两者都返回后立即开始，不等待图层
+                pool = ThreadPoolExecutor(max_workers=3, thread_name_prefix="postprocess")
+                try:
+                    translate_future = pool.submit(chat.get_translate, response, priority=self.priority)
+                    emotion_future = pool.submit(
+                        chat.get_emotion, f"用户：{self.prompt}\n丛雨：{response}", self.emotion_history,
+                        priority=self.priority)
+                    layers_future = pool.submit(
+                        chat.get_embedings_layers, response, "b", self.embeddings_history, priority=self.priority)
 
-            if self.interrupt_event and self.interrupt_event.is_set():
-                print("LLMWorker interrupted before start")
-                return
+                    translated = translate_future.result()
+                    emotion, emotion_history = emotion_future.result()
+
+                    if self.interrupt_event and self.interrupt_event.is_set():
+                        print("LLMWorker interrupted before start")
+                        return
 
-            embeddings_layers, embeddings_history = chat.get_embedings_layers(
-                response, "b", self.embeddings_history)
+                    tts_future = tts_executor.submit(chat.generate_tts, translated, emotion)
+
+                    embeddings_layers, embeddings_history = layers_future.result()
+                finally:
+                    # 被中断时不等待仍在进行的请求
+                    pool.shutdown(wait=False)
 
             if self.interrupt_event and self.interrupt_event.is_set():
                 print("LLMWorker interrupted before start")
                 return
 
-            raw_response_md5 = hashlib.md5(translated.encode()).hexdigest()
-            voice_path = f"./voices/{raw_response_md5}.wav"
-
-            while not os.path.exists(voice_path):
-                time.sleep(0.1)
-                if self.interrupt_event and self.interrupt_event.is_set():
-                    return
+            # 合成完成时立即返回；超时只用于定期检查是否被中断
+            while True:
+                try:
+                    audio = tts_future.result(timeout=0.1)
+                    break
+                except FutureTimeoutError:
+                    if self.interrupt_event and self.interrupt_event.is_set():
+                        return
 
             print(len(history), "history")
             print(embeddings_layers, "b")
@@ -722,7 +947,11 @@ class LLMWorker(QThread):
 
             result = f"「{wrap_text(response)}」"
             self.finished.emit(result, history, emotion_history,
-                               embeddings_history, embeddings_layers, translated)
+                               embeddings_history, embeddings_layers, audio)
+        except chat.RequestDropped as e:
+            print(f"LLMWorker dropped by server (busy): {e}")
+        except chat.RequestCancelled as e:
+            print(f"LLMWorker cancelled: {e}")
         except Exception as e:
             print("--- LLMWorker Error ---")
             tb_str = traceback.format_exc()
@@ -771,6 +1000,12 @@ def clear_history(parent):
     reply = QMessageBox.question(parent, "Clear History", "Are you sure you want to clear the history?",
                                  QMessageBox.Ok | QMessageBox.Cancel)
     if reply == QMessageBox.Ok:
+        if murasame.session_id:
+            try:
+                chat.delete_session(murasame.session_id)
+            except Exception as e:
+                print(f"Failed to delete session: {e}")
+            murasame.session_id = uuid.uuid4().hex
         murasame.history = chat.identity()
         murasame.emotion_history = []
         murasame.embeddings_history = []
@@ -816,9 +1051,13 @@ if __name__ == "__main__":
 
         def handle_screen_result(des_text):
             murasame.llm_worker = LLMWorker(
-                des_text, murasame.history, murasame.emotion_history, murasame.embeddings_history, role="system"
+                des_text, murasame.history, murasame.emotion_history, murasame.embeddings_history, role="system",
+                session_id=murasame.session_id, priority="background",
+                # 用户开始输入时 handle_user_input 会设置该事件，取消这条仍在生成的后台回复
+                interrupt_event=screen_worker.interrupt_event
             )
             murasame.llm_worker.finished.connect(murasame.on_llm_result)
+            murasame.llm_worker.sentence_ready.connect(murasame.on_sentence_ready)
             murasame.llm_worker.start()
 
         screen_worker.screen_result.connect(handle_screen_result)